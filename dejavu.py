@@ -8,8 +8,13 @@ import sys
 import warnings
 from argparse import RawTextHelpFormatter
 
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
 from dejavu import Dejavu
-from dejavu.recognize import FileRecognizer
+from dejavu.database_index import write_index
+from dejavu.recognize import FileRecognizer, StreamRecognizer
+from dejavu.server import (DEFAULT_MAX_CLIP_SIZE, DEFAULT_PORT,
+                           RecognitionServer)
 
 warnings.filterwarnings("ignore")
 
@@ -55,12 +60,46 @@ if __name__ == '__main__':
                              'playing through the microphone\n'
                              'Usage: \n'
                              '--recognize mic number_of_seconds \n'
+                             '--recognize stdin sample_rate channels (raw 16 bit PCM)\n'
                              '--recognize file path/to/file split_milliseconds start_milliseconds limit_milliseconds\n')
+    parser.add_argument('-m', '--migrate-format', nargs='*',
+                        help='Convert the database to another fingerprint '
+                             'format (sha1 or packed),\n'
+                             'fingerprinting the songs again from a directory\n'
+                             'Usage: \n'
+                             '--migrate-format packed /path/to/directory extension\n')
+    parser.add_argument('-i', '--build-index', nargs='?',
+                        help='Write the configured database to a read-only\n'
+                             'index file for the "index" database type\n'
+                             'Usage: \n'
+                             '--build-index /path/to/file.djvidx\n')
+    parser.add_argument('--rebuild-stats', action='store_true',
+                        help='Recount the number of fingerprints of every\n'
+                             'hash, used by the "stop_frequency" option\n')
+    parser.add_argument('--validate-peaks', nargs='?',
+                        help='Compare the fast peak detector with the\n'
+                             'reference one on every channel of a file\n'
+                             'Usage: \n'
+                             '--validate-peaks path/to/file\n')
+    parser.add_argument('-s', '--serve', nargs='?', const=str(DEFAULT_PORT),
+                        help='Run an HTTP recognition server, audio clips\n'
+                             'are POSTed to /recognize\n'
+                             'Usage: \n'
+                             '--serve [host:]port\n')
+    parser.add_argument('-p', '--processes', type=int,
+                        help='Number of processes recognizing the segments\n'
+                             'of a file in parallel, or fingerprinting\n'
+                             'clips for --serve\n'
+                             'Usage: \n'
+                             '--recognize file path/to/file --processes 4\n')
     parser.add_argument('--debug', action='store_true', 
                         help='Enable debug mode to add original clips between found clips.\n')
     args = parser.parse_args()
 
-    if not args.fingerprint and not args.recognize:
+    if (not args.fingerprint and not args.recognize and
+            not args.migrate_format and not args.build_index and
+            not args.rebuild_stats and not args.validate_peaks and
+            not args.serve):
         parser.print_help()
         sys.exit(0)
 
@@ -71,6 +110,18 @@ if __name__ == '__main__':
 
     debug = args.debug
 
+    if args.validate_peaks:
+        # needs no database
+        channels, Fs = decoder.read_file(args.validate_peaks)
+        for channeln, channel in enumerate(channels):
+            report = fingerprint.validate_peaks(channel, Fs=Fs)
+            print('Channel %d: %d reference and %d fast peaks, %d common '
+                  '(agreement %.5f)%s'
+                  % (channeln + 1, report['reference'], report['fast'],
+                     report['common'], report['agreement'],
+                     ', identical' if report['identical'] else ''))
+        sys.exit(0)
+
     djv = init(config_file)
     if args.fingerprint:
         # Fingerprint all files in a directory
@@ -80,6 +131,7 @@ if __name__ == '__main__':
             print('Fingerprinting all .%s files in the %s directory'
                   % (extension, directory))
             djv.fingerprint_directory(directory, ['.' + extension], 4)
+            djv.close()
 
         elif len(args.fingerprint) == 1:
             filepath = args.fingerprint[0]
@@ -88,6 +140,57 @@ if __name__ == '__main__':
                 sys.exit(1)
             djv.fingerprint_file(filepath)
 
+    elif args.migrate_format:
+        if len(args.migrate_format) != 3:
+            print('Please specify a format, directory and extension to migrate!')
+            sys.exit(1)
+        hash_format, directory, extension = args.migrate_format
+        print('Migrating to %s fingerprints from .%s files in the %s directory'
+              % (hash_format, extension, directory))
+        missing = djv.migrate_hash_format(hash_format, directory,
+                                          ['.' + extension], 4)
+        if missing:
+            for song in missing:
+                print('No audio file found for %s' % song['song_name'])
+            print('Nothing was migrated.')
+            sys.exit(1)
+        print("Done, set \"hash_format\": \"%s\" in the database section "
+              "of your configuration." % hash_format)
+
+    elif args.build_index:
+        print('Writing index of %d songs to %s'
+              % (djv.db.get_num_songs(), args.build_index))
+        write_index(args.build_index, djv.db)
+
+    elif args.rebuild_stats:
+        print('Rebuilding hash statistics of %d fingerprints'
+              % djv.db.get_num_fingerprints())
+        djv.db.rebuild_hash_stats()
+
+    elif args.serve:
+        host, _, port = args.serve.rpartition(':')
+        server = RecognitionServer(
+            djv, (host, int(port)), nprocesses=args.processes,
+            max_clip_size=djv.config.get("max_clip_size",
+                                         DEFAULT_MAX_CLIP_SIZE))
+        print('Serving recognition on %s:%s' % (host or '*', port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+
+    elif args.recognize and args.recognize[0] == 'stdin':
+        # Recognize raw PCM piped in, e.g. from
+        # ffmpeg -i input -f s16le -ar 44100 -ac 1 -
+        Fs = int(args.recognize[1]) if len(args.recognize) > 1 else 44100
+        channels = int(args.recognize[2]) if len(args.recognize) > 2 else 1
+        recognizer = StreamRecognizer(djv, Fs=Fs, channels=channels)
+        for song in recognizer.listen(sys.stdin):
+            print(song)
+            sys.stdout.flush()
+
     elif args.recognize:
         # Recognize audio source
         songs = []
@@ -105,7 +208,8 @@ if __name__ == '__main__':
         except:
             limit_milliseconds = None
 
-        songs = FileRecognizer(djv).recognize(opt_arg, split_milliseconds, start_milliseconds, limit_milliseconds)
+        songs = FileRecognizer(djv).recognize(opt_arg, split_milliseconds, start_milliseconds, limit_milliseconds,
+                                              nprocesses=args.processes)
 
         subprocess.check_output('rm -f results/out*', shell=True)
 
@@ -1,13 +1,17 @@
 import multiprocessing
 import os
 import sys
+import threading
 import traceback
+from functools import partial
 
-from pydub import AudioSegment
+import numpy as np
 
 import dejavu.decoder as decoder
 import fingerprint
 from dejavu.database import get_database, Database
+from dejavu.ingest import (IngestPipeline, DEFAULT_BATCH_SIZE,
+                           DEFAULT_SCANNERS, decode_file, fingerprint_channels)
 
 
 class Dejavu(object):
@@ -17,6 +21,10 @@ class Dejavu(object):
     MATCH_TIME = 'match_time'
     OFFSET = 'offset'
     OFFSET_SECS = 'offset_seconds'
+    INPUT_HASHES = 'input_total_hashes'
+    INPUT_CONFIDENCE = 'input_confidence'
+    FINGERPRINTED_HASHES = 'fingerprinted_hashes_in_db'
+    FINGERPRINTED_CONFIDENCE = 'fingerprinted_confidence'
 
     def __init__(self, config):
         super(Dejavu, self).__init__()
@@ -34,15 +42,23 @@ class Dejavu(object):
         self.limit = self.config.get("fingerprint_limit", None)
         if self.limit == -1:  # for JSON compatibility
             self.limit = None
+
+        self._songs_lock = threading.Lock()
+        self.songhashes_set = set()
         self.get_fingerprinted_songs()
 
+        # started by the first fingerprint_directory call
+        self._ingest = None
+
     def get_fingerprinted_songs(self):
         # get songs previously indexed
         self.songs = self.db.get_songs()
-        self.songhashes_set = set()  # to know which ones we've computed before
-        for song in self.songs:
-            song_hash = song[Database.FIELD_FILE_SHA1]
-            self.songhashes_set.add(song_hash)
+        with self._songs_lock:
+            # updated in place, the ingest pipeline shares this set
+            self.songhashes_set.clear()  # to know which ones we've computed before
+            for song in self.songs:
+                song_hash = song[Database.FIELD_FILE_SHA1]
+                self.songhashes_set.add(song_hash)
 
     def fingerprint_directory(self, path, extensions, nprocesses=None):
         # Try to use the maximum amount of processes if not given.
@@ -53,124 +69,274 @@ class Dejavu(object):
         else:
             nprocesses = 1 if nprocesses <= 0 else nprocesses
 
-        pool = multiprocessing.Pool(nprocesses)
-
-        filenames_to_fingerprint = []
-        for filename, _ in decoder.find_files(path, extensions):
-
-            # don't refingerprint already fingerprinted files
-            if decoder.unique_hash(filename) in self.songhashes_set:
-                print "%s already fingerprinted, continuing..." % filename
-                continue
-
-            filenames_to_fingerprint.append(filename)
+        pipeline = self._ingest_pipeline(nprocesses)
 
-        # Send off our tasks
-        iterator = pool.imap_unordered(_fingerprint_worker, filenames_to_fingerprint)
-
-        # Loop till we have all of them
-        while True:
-            try:
-                song_name, hashes, file_hash = iterator.next()
-            except multiprocessing.TimeoutError:
-                continue
-            except StopIteration:
-                break
-            except:
-                print("Failed fingerprinting")
-                # Print traceback because we can't reraise it here
-                traceback.print_exc(file=sys.stdout)
-            else:
-                sid = self.db.insert_song(song_name, file_hash)
+        self.db.begin_bulk_load()
+        try:
+            # already fingerprinted files are skipped by the pipeline's
+            # scanners, which hash files in parallel with decoding
+            for filename, _ in decoder.find_files(path, extensions):
+                pipeline.submit(filename)
 
-                self.db.insert_hashes(sid, hashes)
-                self.db.set_song_fingerprinted(sid)
-                self.get_fingerprinted_songs()
+            # Loop till we have all of them
+            pipeline.wait()
+        finally:
+            self.db.end_bulk_load()
 
-        pool.close()
-        pool.join()
+    def _ingest_pipeline(self, nprocesses):
+        """
+        Returns the ingest pipeline, (re)starting it if it isn't running
+        with the worker counts for `nprocesses`.
+        """
+        options = self.config.get("ingest", {})
+        scanners = options.get("scanners", DEFAULT_SCANNERS)
+        decoders = options.get("decoders", max(nprocesses // 2, 1))
+        fingerprinters = options.get("fingerprinters", nprocesses)
+        writers = options.get("writers", 1)
+        workers = (scanners, decoders, fingerprinters, writers)
+
+        if self._ingest is not None and (self._ingest.workers != workers or
+                                         self._ingest.broken):
+            self.close()
+        if self._ingest is None:
+            hash_cache = options.get("hash_cache")
+            self._ingest = IngestPipeline(
+                self.db, self.songhashes_set, self._songs_lock,
+                decoders=decoders, fingerprinters=fingerprinters,
+                writers=writers,
+                batch_size=options.get("batch_size", DEFAULT_BATCH_SIZE),
+                scanners=scanners,
+                hash_cache=decoder.HashCache(hash_cache) if hash_cache else None)
+        return self._ingest
+
+    def close(self):
+        """
+        Stops the ingest workers started by `fingerprint_directory`.
+        """
+        if self._ingest is not None:
+            self._ingest.close()
+            if self._ingest.hash_cache is not None:
+                self._ingest.hash_cache.close()
+            self._ingest = None
 
     def fingerprint_file(self, filepath, song_name=None):
         songname = decoder.path_to_songname(filepath)
         song_name = song_name or songname
         song_name, hashes, file_hash = _fingerprint_worker(
             filepath,
-            song_name=song_name
+            song_name=song_name,
+            hash_format=self.db.hash_format,
+            profile=self.db.profile
         )
-        sid = self.db.insert_song(song_name, file_hash)
+        self.db.insert_songs([(song_name, file_hash, hashes)])
+        with self._songs_lock:
+            self.songhashes_set.add(file_hash)
 
-        self.db.insert_hashes(sid, hashes)
-        self.db.set_song_fingerprinted(sid)
-        self.get_fingerprinted_songs()
+    def migrate_hash_format(self, hash_format, path, extensions,
+                            nprocesses=None):
+        """
+        Converts the database to another fingerprint format.
+
+        Hashes can't be converted in place (SHA1 is one-way), so every song
+        is fingerprinted again from the audio files found in `path`. Files
+        are matched to songs by their file SHA1, keeping the song ids.
+        The new fingerprints only replace the old ones once every song was
+        fingerprinted again; if a file fails, `MigrationError` is raised
+        and the database is left as it was.
+
+        Returns the songs for which no audio file was found. Nothing is
+        changed then, so a wrong path or extension doesn't lose anything.
+        """
+        songs = {}
+        for song in self.db.get_songs():
+            songs[song[Database.FIELD_FILE_SHA1]] = song
+
+        filenames = {}
+        for filename, _ in decoder.find_files(path, extensions):
+            file_hash = decoder.unique_hash(filename)
+            if file_hash in songs:
+                filenames[file_hash] = filename
+        missing = [song for file_hash, song in songs.iteritems()
+                   if file_hash not in filenames]
+        if missing:
+            return missing
+
+        try:
+            nprocesses = nprocesses or multiprocessing.cpu_count()
+        except NotImplementedError:
+            nprocesses = 1
+        else:
+            nprocesses = 1 if nprocesses <= 0 else nprocesses
+
+        pool = multiprocessing.Pool(nprocesses)
+        worker = partial(_fingerprint_worker, hash_format=hash_format,
+                         profile=self.db.profile)
+
+        def fingerprinted():
+            iterator = pool.imap_unordered(worker, filenames.values())
+            failures = 0
+            while True:
+                try:
+                    song_name, hashes, file_hash = iterator.next()
+                except multiprocessing.TimeoutError:
+                    continue
+                except StopIteration:
+                    break
+                except Exception:
+                    print("Failed fingerprinting")
+                    traceback.print_exc(file=sys.stdout)
+                    failures += 1
+                else:
+                    yield songs[file_hash][Database.FIELD_SONG_ID], hashes
+
+            if failures:
+                raise MigrationError("%d of %d files could not be "
+                                     "fingerprinted, the database was left "
+                                     "unchanged." % (failures, len(filenames)))
+
+        try:
+            self.db.change_hash_format(hash_format, fingerprinted())
+        finally:
+            pool.terminate()
+            pool.join()
+        return []
+
+    def generate_fingerprints(self, samples, Fs=fingerprint.DEFAULT_FS):
+        """
+        Fingerprints samples in the hash format, and with the analysis
+        profile, of the database.
+        """
+        return fingerprint.fingerprint(samples, Fs=Fs,
+                                       hash_format=self.db.hash_format,
+                                       profile=self.db.profile)
 
     def find_matches(self, samples, Fs=fingerprint.DEFAULT_FS):
-        hashes = fingerprint.fingerprint(samples, Fs=Fs)
+        hashes = self.generate_fingerprints(samples, Fs=Fs)
         return self.db.return_matches(hashes)
 
-    def align_matches(self, matches):
+    def find_match_arrays(self, samples, Fs=fingerprint.DEFAULT_FS):
+        """
+        Same as `find_matches`, but returns the matches as a pair of
+        (sids, offset_differences) arrays, ready for `align_matches`.
+        """
+        hashes = self.generate_fingerprints(samples, Fs=Fs)
+        return self.db.return_match_arrays(hashes)
+
+    def align_matches(self, matches, topn=None, input_hashes=None):
         """
             Finds hash matches that align in time with other matches and finds
             consensus about which hashes are "true" signal from the audio.
 
-            Returns a dictionary with match information.
+            `matches` is a sequence of (sid, offset_difference) tuples or a
+            pair of (sids, offset_differences) arrays. `input_hashes` is the
+            number of hashes the matches were looked up for, used to score
+            INPUT_CONFIDENCE.
+
+            Returns a dictionary with match information, or with `topn`
+            a list of up to `topn` of them, one per song, best first.
         """
-        # align by diffs
-        diff_counter = {}
-        largest = 0
-        largest_count = 0
-        song_id = -1
-        for tup in matches:
-            sid, diff = tup
-            if diff not in diff_counter:
-                diff_counter[diff] = {}
-            if sid not in diff_counter[diff]:
-                diff_counter[diff][sid] = 0
-            diff_counter[diff][sid] += 1
-
-            if diff_counter[diff][sid] > largest_count:
-                largest = diff
-                largest_count = diff_counter[diff][sid]
-                song_id = sid
-
-        # extract identification
-        song = self.db.get_song_by_id(song_id)
-        if song:
-            # TODO: Clarify what `get_song_by_id` should return.
-            songname = song.get(Dejavu.SONG_NAME, None)
-        else:
-            return None
-
-        # return match info
-        nseconds = round(float(largest) / fingerprint.DEFAULT_FS *
-                         fingerprint.DEFAULT_WINDOW_SIZE *
-                         fingerprint.DEFAULT_OVERLAP_RATIO, 5)
-        song = {
-            Dejavu.SONG_ID: song_id,
-            Dejavu.SONG_NAME: songname,
-            Dejavu.CONFIDENCE: largest_count,
-            Dejavu.OFFSET: int(largest),
-            Dejavu.OFFSET_SECS: nseconds,
-            Database.FIELD_FILE_SHA1: song.get(Database.FIELD_FILE_SHA1, None), }
-        return song
-
-
-def _fingerprint_worker(filename, song_name=None):
+        sids, diffs = _match_arrays(matches)
+        candidates = _align_candidates(sids, diffs, topn or 1)
+
+        # extract identification, all candidates in one lookup
+        songs = self.db.get_songs_by_ids([sid for sid, _, _ in candidates])
+        # offsets count columns of the database's analysis
+        rate, wsize, _ = fingerprint.analysis(self.db.profile,
+                                              fingerprint.DEFAULT_FS)
+
+        results = []
+        for song_id, largest, largest_count in candidates:
+            song = songs.get(song_id)
+            if song:
+                # TODO: Clarify what `get_song_by_id` should return.
+                songname = song.get(Dejavu.SONG_NAME, None)
+            else:
+                continue
+
+            # return match info
+            nseconds = round(float(largest) / rate * wsize *
+                             fingerprint.DEFAULT_OVERLAP_RATIO, 5)
+            total_hashes = song.get(Database.FIELD_TOTAL_HASHES, None)
+            results.append({
+                Dejavu.SONG_ID: song_id,
+                Dejavu.SONG_NAME: songname,
+                Dejavu.CONFIDENCE: largest_count,
+                Dejavu.OFFSET: int(largest),
+                Dejavu.OFFSET_SECS: nseconds,
+                Dejavu.INPUT_HASHES: input_hashes,
+                Dejavu.INPUT_CONFIDENCE: _ratio(largest_count, input_hashes),
+                Dejavu.FINGERPRINTED_HASHES: total_hashes,
+                Dejavu.FINGERPRINTED_CONFIDENCE: _ratio(largest_count,
+                                                        total_hashes),
+                Database.FIELD_FILE_SHA1: song.get(Database.FIELD_FILE_SHA1, None), })
+
+        if topn is not None:
+            return results
+        return results[0] if results else None
+
+
+def _ratio(count, total):
+    if not total:
+        return None
+    return round(float(count) / total, 5)
+
+
+def _match_arrays(matches):
+    """
+    Returns matches as a pair of (sids, offset_differences) int64 arrays.
+    """
+    if (isinstance(matches, tuple) and len(matches) == 2 and
+            isinstance(matches[0], np.ndarray)):
+        sids, diffs = matches
+        return sids.astype(np.int64), diffs.astype(np.int64)
+
+    matches = np.array(list(matches), dtype=np.int64).reshape(-1, 2)
+    return matches[:, 0], matches[:, 1]
+
+
+def _align_candidates(sids, diffs, n):
+    """
+    Histograms the (sid, offset_difference) matches and returns the `n`
+    songs with the most aligned matches, as (sid, diff, count) tuples of
+    each song's best offset difference.
+
+    Equal counts are ranked by which one reached its count first in
+    `matches`, the same song the original dict-based loop picked.
+    """
+    if not len(sids):
+        return []
+
+    # combine sid and diff into a single int64 key
+    diff_min = diffs.min()
+    span = diffs.max() - diff_min + 1
+    keys = sids * span + (diffs - diff_min)
+
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    counts = np.bincount(inverse)
+
+    # a key reaches its final count at its last occurrence
+    order = np.argsort(inverse, kind='mergesort')
+    reached = order[np.cumsum(counts) - 1]
+
+    # best first, then keep the best key of every song
+    ranked = np.lexsort((reached, -counts))
+    ranked_sids = uniq[ranked] // span
+    _, first = np.unique(ranked_sids, return_index=True)
+    best = ranked[np.sort(first)[:n]]
+
+    return zip((uniq[best] // span).tolist(),
+               (uniq[best] % span + diff_min).tolist(),
+               counts[best].tolist())
+
+
+def _fingerprint_worker(filename, song_name=None,
+                        hash_format=fingerprint.DEFAULT_FINGERPRINT_FORMAT,
+                        profile=None):
     songname, extension = os.path.splitext(os.path.basename(filename))
     song_name = song_name or songname
-    audiofile = AudioSegment.from_file(filename)
-    channels, Fs, file_hash = decoder.read(filename, audiofile)
-    result = set()
-    channel_amount = len(channels)
-
-    for channeln, channel in enumerate(channels):
-        # TODO: Remove prints or change them into optional logging.
-        print("Fingerprinting channel %d/%d for %s" % (channeln + 1,
-                                                       channel_amount,
-                                                       filename))
-        hashes = fingerprint.fingerprint(channel, Fs=Fs)
-        print("Finished channel %d/%d for %s" % (channeln + 1, channel_amount,
-                                                 filename))
-        result |= set(hashes)
+    channels, Fs, file_hash = decode_file(filename)
+    result = fingerprint_channels(channels, Fs, hash_format, filename,
+                                  profile)
 
     return song_name, result, file_hash
 
@@ -181,3 +347,7 @@ def chunkify(lst, n):
     http://stackoverflow.com/questions/2130016/splitting-a-list-of-arbitrary-size-into-only-roughly-n-equal-parts
     """
     return [lst[i::n] for i in xrange(n)]
+
+
+class MigrationError(Exception):
+    pass
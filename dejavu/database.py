@@ -1,5 +1,10 @@
 from __future__ import absolute_import
 import abc
+from itertools import chain
+
+import numpy as np
+
+from dejavu.fingerprint import DEFAULT_FINGERPRINT_FORMAT
 
 
 class Database(object):
@@ -10,11 +15,26 @@ class Database(object):
     FIELD_SONGNAME = 'song_name'
     FIELD_OFFSET = 'offset'
     FIELD_HASH = 'hash'
+    FIELD_TOTAL_HASHES = 'total_hashes'
 
     # Name of your Database subclass, this is used in configuration
     # to refer to your class
     type = None
 
+    # Format of the hashes stored in this database, one of
+    # `dejavu.fingerprint.FINGERPRINT_FORMATS`. Ingest and queries both
+    # fingerprint using this format so they always agree.
+    hash_format = DEFAULT_FINGERPRINT_FORMAT
+
+    # Hashes with more than this many postings are left out of matching,
+    # see `stopped_hashes`; None matches every hash.
+    stop_frequency = None
+
+    # Analysis profile the stored fingerprints were computed with, as
+    # settings of `dejavu.fingerprint.get_profile`. Ingest and queries both
+    # analyse audio this way; None analyses it as decoded.
+    profile = None
+
     def __init__(self):
         super(Database, self).__init__()
 
@@ -92,12 +112,29 @@ class Database(object):
         """
         pass
 
+    def get_songs_by_ids(self, sids):
+        """
+        Returns a dictionary of song identifier => song for all given
+        identifiers that exist, looked up in one go where the database
+        supports it. Songs include FIELD_TOTAL_HASHES, the number of
+        fingerprints stored for them.
+
+        sids: Song identifiers
+        """
+        songs = {}
+        for sid in sids:
+            song = self.get_song_by_id(sid)
+            if song:
+                songs[sid] = song
+        return songs
+
     @abc.abstractmethod
     def insert(self, hash, sid, offset):
         """
         Inserts a single fingerprint into the database.
 
-          hash: Part of a sha1 hash, in hexadecimal format
+          hash: Part of a sha1 hash, in hexadecimal format, or a packed
+                integer hash, depending on `hash_format`
            sid: Song identifier this fingerprint is off
         offset: The offset this hash is from
         """
@@ -127,6 +164,9 @@ class Database(object):
     def get_iterable_kv_pairs(self):
         """
         Returns all fingerprints in the database.
+
+        Returns a sequence of (hash, sid, offset) tuples, hashes in the
+        same format `insert_hashes` accepts.
         """
         pass
 
@@ -137,11 +177,45 @@ class Database(object):
 
            sid: Song identifier the fingerprints belong to
         hashes: A sequence of tuples in the format (hash, offset)
-        -   hash: Part of a sha1 hash, in hexadecimal format
+        -   hash: Part of a sha1 hash, in hexadecimal format, or a packed
+                  integer hash, depending on `hash_format`
         - offset: Offset this hash was created from/at.
         """
         pass
 
+    def insert_songs(self, songs):
+        """
+        Inserts a batch of completely fingerprinted songs, marking them
+        as fingerprinted. Returns the new song identifiers, in order.
+
+        Databases should override this to store the whole batch in as
+        few round trips and transactions as they can.
+
+        songs: A sequence of (song_name, file_hash, hashes) tuples, with
+               hashes as accepted by `insert_hashes`
+        """
+        sids = []
+        for song_name, file_hash, hashes in songs:
+            sid = self.insert_song(song_name, file_hash)
+            self.insert_hashes(sid, hashes)
+            self.set_song_fingerprinted(sid)
+            sids.append(sid)
+        return sids
+
+    def begin_bulk_load(self):
+        """
+        Called before many songs are inserted at once, e.g. a whole
+        directory, so the database can defer work such as index
+        maintenance until `end_bulk_load`.
+        """
+        pass
+
+    def end_bulk_load(self):
+        """
+        Called once the songs announced by `begin_bulk_load` are in.
+        """
+        pass
+
     @abc.abstractmethod
     def return_matches(self, hashes):
         """
@@ -158,6 +232,170 @@ class Database(object):
         """
         pass
 
+    def return_match_arrays(self, hashes):
+        """
+        Same as `return_matches`, but returns the matches as a pair of
+        (sids, offset_differences) int64 arrays.
+
+        A hash occurring at several offsets of the query is looked up
+        once and its postings are paired with every one of its offsets,
+        so repeated phrases keep all their votes. Hashes in
+        `stopped_hashes` aren't looked up at all.
+        """
+        group = group_hashes(hashes)
+        keys, starts, query_offsets = drop_hashes(
+            group, self.stopped_hashes(group[0]))
+        owner, sids, offsets = self.return_postings(keys)
+        pairs, diffs = pair_offsets(owner, offsets, starts, query_offsets)
+        return sids[pairs], diffs
+
+    def return_postings(self, hashes):
+        """
+        Looks up a list of distinct hashes in one pass.
+
+        returns: (owner, sids, offsets) int64 arrays, one entry per stored
+        fingerprint, `owner` being the index in `hashes` of its hash
+
+        Subclasses should override this with a bulk lookup.
+        """
+        postings = [(i, sid, offset)
+                    for i, hash in enumerate(hashes)
+                    for sid, offset in self.query(hash)]
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        return postings[:, 0], postings[:, 1], postings[:, 2]
+
+    def return_segment_match_arrays(self, segments):
+        """
+        Same as `return_match_arrays` for many lists of
+        (hash, sample_offset) values at once, e.g. the segments of a long
+        recording. Hashes repeated between lists are looked up only once,
+        with a single `return_postings` call, and the postings are then
+        fanned back out to every list.
+
+        returns: a (sids, offset_differences) pair of arrays per list
+        """
+        groups = [group_hashes(hashes) for hashes in segments]
+        keys = list(set().union(*[group[0] for group in groups]))
+        stopped = self.stopped_hashes(keys)
+        if stopped:
+            groups = [drop_hashes(group, stopped) for group in groups]
+            keys = [key for key in keys if key not in stopped]
+        index = dict((key, i) for i, key in enumerate(keys))
+
+        owner, sids, offsets = self.return_postings(keys)
+        # group the postings by hash
+        order = np.argsort(owner, kind='mergesort')
+        owner, sids, offsets = owner[order], sids[order], offsets[order]
+        starts = np.searchsorted(owner, np.arange(len(keys)), side='left')
+        ends = np.searchsorted(owner, np.arange(len(keys)), side='right')
+
+        results = []
+        for segment_keys, query_starts, query_offsets in groups:
+            idx = np.array([index[key] for key in segment_keys],
+                           dtype=np.int64)
+            segment_owner, positions = expand_postings(starts[idx], ends[idx])
+            pairs, diffs = pair_offsets(segment_owner, offsets[positions],
+                                        query_starts, query_offsets)
+            results.append((sids[positions][pairs], diffs))
+        return results
+
+    def return_hash_counts(self, hashes):
+        """
+        Returns the number of postings stored for each of a list of
+        distinct hashes, as an int64 array.
+
+        Subclasses should override this with a bulk lookup.
+        """
+        return np.array([sum(1 for _ in self.query(hash)) for hash in hashes],
+                        dtype=np.int64)
+
+    def stopped_hashes(self, hashes):
+        """
+        Returns the set of the distinct `hashes` that have more than
+        `stop_frequency` postings. Such hashes are shared by so many songs
+        and offsets that they add lots of matches without telling songs
+        apart, so matching ignores them.
+        """
+        if self.stop_frequency is None or not len(hashes):
+            return set()
+        counts = self.return_hash_counts(hashes)
+        return set(hash for hash, count in zip(hashes, counts.tolist())
+                   if count > self.stop_frequency)
+
+    def rebuild_hash_stats(self):
+        """
+        Recounts the postings of every hash, for databases that keep
+        them in statistics maintained as fingerprints are inserted.
+        """
+        pass
+
+
+def group_hashes(hashes):
+    """
+    Groups a list of (hash, sample_offset) values by hash.
+
+    returns: (keys, starts, offsets), the distinct hashes and an int64
+    array of their offsets, those of keys[i] being
+    offsets[starts[i]:starts[i + 1]]
+    """
+    groups = {}
+    for hash, offset in hashes:
+        groups.setdefault(hash, []).append(offset)
+
+    keys = groups.keys()
+    lengths = np.array([len(groups[key]) for key in keys], dtype=np.int64)
+    starts = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    offsets = np.fromiter(chain.from_iterable(groups[key] for key in keys),
+                          dtype=np.int64, count=int(starts[-1]))
+    return keys, starts, offsets
+
+
+def drop_hashes(group, stopped):
+    """
+    Removes the hashes in the set `stopped`, and their offsets, from
+    hashes grouped by `group_hashes`.
+
+    returns: (keys, starts, offsets) like `group_hashes`
+    """
+    if not stopped:
+        return group
+
+    keys, starts, offsets = group
+    keep = np.array([key not in stopped for key in keys], dtype=bool)
+    lengths = np.diff(starts)
+    starts = np.concatenate(([0], np.cumsum(lengths[keep]))).astype(np.int64)
+    return ([key for key, kept in zip(keys, keep) if kept], starts,
+            offsets[np.repeat(keep, lengths)])
+
+
+def pair_offsets(owner, offsets, starts, query_offsets):
+    """
+    Pairs every posting with every query offset of its hash, as grouped
+    by `group_hashes`; `owner` and `offsets` are the key index and stored
+    offset of each posting.
+
+    returns: (postings, diffs) arrays, the index of the posting of each
+    pair and its offset difference
+    """
+    postings, positions = expand_postings(starts[owner], starts[owner + 1])
+    return postings, offsets[postings] - query_offsets[positions]
+
+
+def expand_postings(starts, ends):
+    """
+    Expands [start, end) posting ranges, one per query hash, into the
+    positions of every posting.
+
+    returns: (owner, positions) arrays, `owner` being the index of the
+    query hash each posting belongs to
+    """
+    counts = ends - starts
+    owner = np.repeat(np.arange(len(counts)), counts)
+    positions = (np.arange(counts.sum()) -
+                 np.repeat(np.cumsum(counts) - counts, counts) +
+                 starts[owner])
+    return owner, positions
+
 
 def get_database(database_type=None):
     # Default to using the mysql database
@@ -174,3 +412,5 @@ def get_database(database_type=None):
 
 # Import our default database handler
 import dejavu.database_sql
+import dejavu.database_memory
+import dejavu.database_index
@@ -0,0 +1,352 @@
+from __future__ import absolute_import
+import binascii
+import json
+import mmap
+import struct
+
+import numpy as np
+
+from dejavu.database import Database, expand_postings
+from dejavu.fingerprint import (FINGERPRINT_FORMAT_PACKED,
+                                FINGERPRINT_REDUCTION, PROFILE_FULL,
+                                get_profile)
+
+
+class IndexDatabase(Database):
+    """
+    Read-only database backed by an immutable, memory-mapped index file.
+
+    The file holds the sorted unique hashes, a postings table of
+    (song_id, offset) pairs grouped by hash and the song table; see
+    `write_index` for building one from another database. Opening it
+    only maps the file, so start-up is instant, and processes mapping
+    the same file share a single copy of it in the page cache.
+
+    File layout:
+
+        MAGIC, header length (uint64), JSON header,
+        padding up to ALIGNMENT, then the arrays listed in the header
+    """
+
+    type = "index"
+
+    MAGIC = "DJVIDX01"
+    ALIGNMENT = 64
+
+    # arrays
+    ARRAY_HASHES = "hashes"
+    ARRAY_STARTS = "starts"
+    ARRAY_SIDS = "sids"
+    ARRAY_OFFSETS = "offsets"
+
+    def __init__(self, path, hash_format=None, stop_frequency=None,
+                 profile=None):
+        super(IndexDatabase, self).__init__()
+        self.path = path
+        self.stop_frequency = stop_frequency
+        self._open()
+
+        if hash_format is not None and hash_format != self.hash_format:
+            raise ValueError("Index %s holds %r fingerprints but %r was "
+                             "configured." % (path, self.hash_format,
+                                              hash_format))
+        if profile is not None and get_profile(profile) != self.profile:
+            raise ValueError("Index %s was fingerprinted with the %r "
+                             "profile but %r was configured." %
+                             (path, self.profile, profile))
+
+    def _open(self):
+        with open(self.path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic = self._mmap[:len(self.MAGIC)]
+        if magic != self.MAGIC:
+            raise IOError("%s is not a dejavu index file." % self.path)
+
+        header_start = len(self.MAGIC) + 8
+        header_length, = struct.unpack(
+            "<Q", self._mmap[len(self.MAGIC):header_start])
+        header = json.loads(
+            self._mmap[header_start:header_start + header_length])
+        data_start = _align(header_start + header_length, self.ALIGNMENT)
+
+        self.hash_format = header["hash_format"]
+        # indexes written before profiles were recorded are full ones
+        self.profile = get_profile(header.get("profile", PROFILE_FULL))
+        self._arrays = {}
+        for name, (dtype, offset, count) in header["arrays"].iteritems():
+            self._arrays[name] = np.frombuffer(
+                self._mmap, dtype=np.dtype(str(dtype)), count=count,
+                offset=data_start + offset)
+
+        self._songs = {}
+        for sid, song_name, file_sha1, total_hashes in header["songs"]:
+            self._songs[sid] = {
+                Database.FIELD_SONGNAME: song_name,
+                Database.FIELD_FILE_SHA1: file_sha1,
+                Database.FIELD_TOTAL_HASHES: total_hashes,
+            }
+
+    def _keys(self, hashes):
+        """
+        Converts hashes to the key representation used in the file.
+        """
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            return np.asarray(hashes, dtype=np.int64)
+        return _unhexlify_keys(hashes)
+
+    def _lookup(self, keys):
+        """
+        Returns the [start, end) postings range of every key.
+        """
+        hashes = self._arrays[self.ARRAY_HASHES]
+        starts = self._arrays[self.ARRAY_STARTS]
+
+        idx = np.searchsorted(hashes, keys)
+        found = idx < len(hashes)
+        found[found] = hashes[idx[found]] == keys[found]
+        idx[~found] = 0
+
+        begin = starts[idx]
+        end = np.where(found, starts[idx + 1], begin)
+        return begin, end
+
+    def empty(self):
+        raise IndexReadOnlyError("Index %s is read-only." % self.path)
+
+    def delete_unfingerprinted_songs(self):
+        """
+        Index files only hold fingerprinted songs, nothing to remove.
+        """
+        pass
+
+    def get_num_songs(self):
+        """
+        Returns number of songs in the index.
+        """
+        return len(self._songs)
+
+    def get_num_fingerprints(self):
+        """
+        Returns number of fingerprints in the index.
+        """
+        return len(self._arrays[self.ARRAY_SIDS])
+
+    def set_song_fingerprinted(self, sid):
+        raise IndexReadOnlyError("Index %s is read-only." % self.path)
+
+    def get_songs(self):
+        """
+        Return all songs in the index.
+        """
+        for sid, song in sorted(self._songs.items()):
+            song = dict(song)
+            song[Database.FIELD_SONG_ID] = sid
+            yield song
+
+    def get_song_by_id(self, sid):
+        """
+        Returns song by its ID.
+        """
+        song = self._songs.get(sid)
+        return dict(song) if song is not None else None
+
+    def get_songs_by_ids(self, sids):
+        """
+        Returns a dictionary of song ID => song for the given IDs.
+        """
+        return dict((sid, dict(self._songs[sid]))
+                    for sid in sids if sid in self._songs)
+
+    def insert(self, hash, sid, offset):
+        raise IndexReadOnlyError("Index %s is read-only." % self.path)
+
+    def insert_song(self, songname, file_hash):
+        raise IndexReadOnlyError("Index %s is read-only." % self.path)
+
+    def insert_hashes(self, sid, hashes):
+        raise IndexReadOnlyError("Index %s is read-only." % self.path)
+
+    def query(self, hash):
+        """
+        Return all (song_id, offset) tuples associated with hash.
+
+        If hash is None, returns all entries in the index.
+        """
+        sids = self._arrays[self.ARRAY_SIDS]
+        offsets = self._arrays[self.ARRAY_OFFSETS]
+        if hash is not None:
+            begin, end = self._lookup(self._keys([hash]))
+            sids, offsets = sids[begin[0]:end[0]], offsets[begin[0]:end[0]]
+
+        for sid, offset in zip(sids.tolist(), offsets.tolist()):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        """
+        Returns all (hash, song_id, offset) tuples in the index.
+        """
+        hashes = self._arrays[self.ARRAY_HASHES]
+        starts = self._arrays[self.ARRAY_STARTS]
+        sids = self._arrays[self.ARRAY_SIDS]
+        offsets = self._arrays[self.ARRAY_OFFSETS]
+        packed = self.hash_format == FINGERPRINT_FORMAT_PACKED
+        nbytes = hashes.dtype.itemsize
+
+        for i, key in enumerate(hashes.tolist()):
+            if not packed:
+                # NumPy drops trailing NUL bytes of raw sha1 keys
+                key = binascii.hexlify(key.ljust(nbytes, "\0"))
+            for j in xrange(starts[i], starts[i + 1]):
+                yield (key, int(sids[j]), int(offsets[j]))
+
+    def return_matches(self, hashes):
+        """
+        Return the (song_id, offset_diff) tuples associated with
+        a list of (hash, sample_offset) values.
+        """
+        sids, diffs = self.return_match_arrays(hashes)
+        for sid, diff in zip(sids.tolist(), diffs.tolist()):
+            # (sid, db_offset - song_sampled_offset)
+            yield (sid, diff)
+
+    def return_postings(self, hashes):
+        """
+        Looks up a list of distinct hashes in one pass.
+
+        returns: (owner, sids, offsets) int64 arrays, `owner` being the
+        index in `hashes` of each posting's hash
+        """
+        if not len(hashes):
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+
+        owner, positions = expand_postings(*self._lookup(self._keys(hashes)))
+        return (owner,
+                self._arrays[self.ARRAY_SIDS][positions].astype(np.int64),
+                self._arrays[self.ARRAY_OFFSETS][positions].astype(np.int64))
+
+    def return_hash_counts(self, hashes):
+        """
+        Returns the number of postings of each hash, read off the
+        postings ranges.
+        """
+        begin, end = self._lookup(self._keys(hashes))
+        return (end - begin).astype(np.int64)
+
+    def __getstate__(self):
+        return (self.path, self.stop_frequency)
+
+    def __setstate__(self, state):
+        self.path, self.stop_frequency = state
+        self._open()
+
+
+class IndexReadOnlyError(Exception):
+    pass
+
+
+def write_index(path, db, chunk_size=1000000):
+    """
+    Builds an index file at `path` from all fingerprinted songs in `db`,
+    any other `Database`, reading its fingerprints through
+    `get_iterable_kv_pairs`.
+    """
+    songs = sorted((song[Database.FIELD_SONG_ID],
+                    song[Database.FIELD_SONGNAME],
+                    song[Database.FIELD_FILE_SHA1])
+                   for song in db.get_songs())
+    song_ids = np.array([sid for sid, _, _ in songs], dtype=np.uint32)
+
+    # read fingerprints in chunks of arrays rather than one big list
+    packed = db.hash_format == FINGERPRINT_FORMAT_PACKED
+    chunks = []
+    rows = []
+
+    def flush():
+        hashes, sids, offsets = zip(*rows)
+        if packed:
+            hashes = np.asarray(hashes, dtype=np.int64)
+        else:
+            hashes = _unhexlify_keys(hashes)
+        sids = np.asarray(sids, dtype=np.uint32)
+        offsets = np.asarray(offsets, dtype=np.uint32)
+        # songs that were never completely fingerprinted are left out
+        known = np.in1d(sids, song_ids)
+        chunks.append((hashes[known], sids[known], offsets[known]))
+        del rows[:]
+
+    for row in db.get_iterable_kv_pairs():
+        rows.append(row)
+        if len(rows) >= chunk_size:
+            flush()
+    if rows:
+        flush()
+
+    if chunks:
+        hashes, sids, offsets = [np.concatenate(c) for c in zip(*chunks)]
+        del chunks[:]
+    else:
+        hashes = (np.empty(0, dtype=np.int64) if packed
+                  else _unhexlify_keys([]))
+        sids = np.empty(0, dtype=np.uint32)
+        offsets = np.empty(0, dtype=np.uint32)
+
+    # songs keep their number of fingerprints in the index
+    if songs:
+        totals = np.bincount(sids, minlength=int(song_ids.max()) + 1)
+        songs = [song + (int(totals[song[0]]),) for song in songs]
+
+    order = np.argsort(hashes, kind='mergesort')
+    hashes, sids, offsets = hashes[order], sids[order], offsets[order]
+
+    # unique keys and where each one's postings start
+    if len(hashes):
+        first = np.concatenate(([True], hashes[1:] != hashes[:-1]))
+    else:
+        first = np.empty(0, dtype=bool)
+    starts = np.append(np.flatnonzero(first), len(hashes)).astype(np.int64)
+    arrays = [
+        (IndexDatabase.ARRAY_HASHES, hashes[first]),
+        (IndexDatabase.ARRAY_STARTS, starts),
+        (IndexDatabase.ARRAY_SIDS, sids),
+        (IndexDatabase.ARRAY_OFFSETS, offsets),
+    ]
+
+    layout = {}
+    position = 0
+    for name, array in arrays:
+        layout[name] = (array.dtype.str, position, len(array))
+        position = _align(position + array.nbytes, IndexDatabase.ALIGNMENT)
+
+    header = json.dumps({
+        "hash_format": db.hash_format,
+        "profile": get_profile(db.profile),
+        "arrays": layout,
+        "songs": songs,
+    })
+
+    with open(path, "wb") as f:
+        f.write(IndexDatabase.MAGIC)
+        f.write(struct.pack("<Q", len(header)))
+        f.write(header)
+        data_start = _align(f.tell(), IndexDatabase.ALIGNMENT)
+        for name, array in arrays:
+            f.write("\0" * (data_start + layout[name][1] - f.tell()))
+            f.write(array.tostring())
+
+
+def _align(position, alignment):
+    return -(-position // alignment) * alignment
+
+
+def _unhexlify_keys(hashes):
+    """
+    Converts hexadecimal sha1 hashes to their raw bytes, which take half
+    the space and compare the same way.
+    """
+    nbytes = FINGERPRINT_REDUCTION // 2
+    if not len(hashes):
+        return np.empty(0, dtype='S%d' % nbytes)
+    raw = binascii.unhexlify("".join(hashes))
+    return np.frombuffer(raw, dtype='S%d' % nbytes)
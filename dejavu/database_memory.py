@@ -0,0 +1,264 @@
+from __future__ import absolute_import
+import threading
+
+import numpy as np
+
+from dejavu.database import Database, expand_postings
+from dejavu.fingerprint import (FINGERPRINT_FORMATS, FINGERPRINT_FORMAT_PACKED,
+                                FINGERPRINT_REDUCTION, get_profile)
+
+
+class MemoryDatabase(Database):
+    """
+    In-process inverted index of hash => (song_id, offset) postings.
+
+    Postings are kept in three parallel NumPy arrays sorted by hash, so a
+    lookup is a binary search instead of a round trip to a server. Newly
+    inserted fingerprints are buffered and merged into the sorted arrays
+    the next time the index is queried.
+
+    Nothing is persisted, the index lives as long as the process does.
+    """
+
+    type = "memory"
+
+    # fields
+    FIELD_FINGERPRINTED = "fingerprinted"
+
+    def __init__(self, hash_format=None, stop_frequency=None, profile=None):
+        super(MemoryDatabase, self).__init__()
+        if hash_format is not None:
+            if hash_format not in FINGERPRINT_FORMATS:
+                raise ValueError("Unsupported fingerprint format: %r" %
+                                 hash_format)
+            self.hash_format = hash_format
+        self.stop_frequency = stop_frequency
+        self.profile = get_profile(profile)
+
+        self._lock = threading.RLock()
+        self._reset()
+
+    def _reset(self):
+        self._songs = {}
+        self._next_sid = 1
+
+        self._hashes = np.empty(0, dtype=self._hash_dtype())
+        self._sids = np.empty(0, dtype=np.uint32)
+        self._offsets = np.empty(0, dtype=np.int64)
+        # (hashes, sids, offsets) chunks not merged into the index yet
+        self._pending = []
+
+    def _hash_dtype(self):
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            return np.int64
+        return np.dtype('S%d' % FINGERPRINT_REDUCTION)
+
+    def _hash_array(self, hashes):
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            return np.asarray(hashes, dtype=np.int64)
+        return np.char.lower(np.asarray(hashes, dtype=self._hash_dtype()))
+
+    def _index(self):
+        """
+        Merges pending fingerprints and returns the sorted
+        (hashes, sids, offsets) arrays.
+        """
+        with self._lock:
+            if self._pending:
+                chunks = [(self._hashes, self._sids, self._offsets)]
+                chunks.extend(self._pending)
+                hashes, sids, offsets = [np.concatenate(c)
+                                         for c in zip(*chunks)]
+
+                order = np.argsort(hashes, kind='mergesort')
+                self._hashes = hashes[order]
+                self._sids = sids[order]
+                self._offsets = offsets[order]
+                self._pending = []
+
+            return self._hashes, self._sids, self._offsets
+
+    def empty(self):
+        """
+        Removes all songs and fingerprints.
+        """
+        with self._lock:
+            self._reset()
+
+    def delete_unfingerprinted_songs(self):
+        """
+        Removes all songs, and their fingerprints, that were never marked
+        as fingerprinted.
+        """
+        with self._lock:
+            removed = [sid for sid, song in self._songs.iteritems()
+                       if not song[self.FIELD_FINGERPRINTED]]
+            if not removed:
+                return
+
+            for sid in removed:
+                del self._songs[sid]
+
+            hashes, sids, offsets = self._index()
+            keep = ~np.in1d(sids, removed)
+            self._hashes = hashes[keep]
+            self._sids = sids[keep]
+            self._offsets = offsets[keep]
+
+    def get_num_songs(self):
+        """
+        Returns number of songs the database has fingerprinted.
+        """
+        return sum(1 for song in self._songs.itervalues()
+                   if song[self.FIELD_FINGERPRINTED])
+
+    def get_num_fingerprints(self):
+        """
+        Returns number of fingerprints the database has fingerprinted.
+        """
+        with self._lock:
+            return len(self._hashes) + sum(len(chunk[0])
+                                           for chunk in self._pending)
+
+    def set_song_fingerprinted(self, sid):
+        """
+        Set the fingerprinted flag once a song has been completely
+        fingerprinted in the database, and store its number of fingerprints.
+        """
+        with self._lock:
+            total = np.count_nonzero(self._sids == sid)
+            for _, sids, _ in self._pending:
+                total += np.count_nonzero(sids == sid)
+
+            song = self._songs[sid]
+            song[self.FIELD_FINGERPRINTED] = True
+            song[Database.FIELD_TOTAL_HASHES] = int(total)
+
+    def get_songs(self):
+        """
+        Return songs that have the fingerprinted flag set.
+        """
+        for sid, song in sorted(self._songs.items()):
+            if song[self.FIELD_FINGERPRINTED]:
+                yield {
+                    Database.FIELD_SONG_ID: sid,
+                    Database.FIELD_SONGNAME: song[Database.FIELD_SONGNAME],
+                    Database.FIELD_FILE_SHA1: song[Database.FIELD_FILE_SHA1],
+                    Database.FIELD_TOTAL_HASHES:
+                        song[Database.FIELD_TOTAL_HASHES],
+                }
+
+    def get_song_by_id(self, sid):
+        """
+        Returns song by its ID.
+        """
+        song = self._songs.get(sid)
+        if song is None:
+            return None
+
+        return {
+            Database.FIELD_SONGNAME: song[Database.FIELD_SONGNAME],
+            Database.FIELD_FILE_SHA1: song[Database.FIELD_FILE_SHA1],
+            Database.FIELD_TOTAL_HASHES: song[Database.FIELD_TOTAL_HASHES],
+        }
+
+    def insert(self, hash, sid, offset):
+        """
+        Insert a (hash, song_id, offset) fingerprint.
+        """
+        self.insert_hashes(sid, [(hash, offset)])
+
+    def insert_song(self, songname, file_hash):
+        """
+        Inserts song in the database and returns its new ID.
+        """
+        with self._lock:
+            sid = self._next_sid
+            self._next_sid += 1
+            self._songs[sid] = {
+                Database.FIELD_SONGNAME: songname,
+                Database.FIELD_FILE_SHA1: file_hash.upper(),
+                Database.FIELD_TOTAL_HASHES: 0,
+                self.FIELD_FINGERPRINTED: False,
+            }
+            return sid
+
+    def query(self, hash):
+        """
+        Return all (song_id, offset) tuples associated with hash.
+
+        If hash is None, returns all entries in the database.
+        """
+        hashes, sids, offsets = self._index()
+        if hash is not None:
+            key = self._hash_array([hash])[0]
+            start = np.searchsorted(hashes, key, side='left')
+            end = np.searchsorted(hashes, key, side='right')
+            sids, offsets = sids[start:end], offsets[start:end]
+
+        for sid, offset in zip(sids.tolist(), offsets.tolist()):
+            yield (sid, offset)
+
+    def get_iterable_kv_pairs(self):
+        """
+        Returns all (hash, song_id, offset) tuples in database.
+        """
+        hashes, sids, offsets = self._index()
+        for row in zip(hashes.tolist(), sids.tolist(), offsets.tolist()):
+            yield row
+
+    def insert_hashes(self, sid, hashes):
+        """
+        Insert series of hash => song_id, offset
+        values into the database.
+        """
+        hashes = list(hashes)
+        if not hashes:
+            return
+
+        keys, offsets = zip(*hashes)
+        chunk = (self._hash_array(keys),
+                 np.repeat(np.uint32(sid), len(keys)),
+                 np.asarray(offsets, dtype=np.int64))
+        with self._lock:
+            self._pending.append(chunk)
+
+    def return_matches(self, hashes):
+        """
+        Return the (song_id, offset_diff) tuples associated with
+        a list of (hash, sample_offset) values.
+        """
+        sids, diffs = self.return_match_arrays(hashes)
+        for sid, diff in zip(sids.tolist(), diffs.tolist()):
+            # (sid, db_offset - song_sampled_offset)
+            yield (sid, diff)
+
+    def return_postings(self, hashes):
+        """
+        Looks up a list of distinct hashes in one pass.
+
+        returns: (owner, sids, offsets) int64 arrays, `owner` being the
+        index in `hashes` of each posting's hash
+        """
+        if not len(hashes):
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+
+        keys = self._hash_array(hashes)
+        index_hashes, sids, offsets = self._index()
+        owner, positions = expand_postings(
+            np.searchsorted(index_hashes, keys, side='left'),
+            np.searchsorted(index_hashes, keys, side='right'))
+
+        return owner, sids[positions].astype(np.int64), offsets[positions]
+
+    def return_hash_counts(self, hashes):
+        """
+        Returns the number of postings of each hash, read off the sorted
+        index.
+        """
+        keys = self._hash_array(hashes)
+        index_hashes = self._index()[0]
+        return (np.searchsorted(index_hashes, keys, side='right') -
+                np.searchsorted(index_hashes, keys, side='left')
+                ).astype(np.int64)
@@ -1,11 +1,37 @@
 from __future__ import absolute_import
-from itertools import izip_longest
-import Queue
+from collections import defaultdict
+from itertools import izip, izip_longest
+import json
+import tempfile
+import threading
+import time
 
 import MySQLdb as mysql
-from MySQLdb.cursors import DictCursor
+from MySQLdb.cursors import DictCursor, SSCursor
+import numpy as np
 
 from dejavu.database import Database
+from dejavu.fingerprint import (FINGERPRINT_FORMATS, FINGERPRINT_FORMAT_SHA1,
+                                FINGERPRINT_FORMAT_PACKED, PROFILE_FULL,
+                                get_profile)
+
+######################################################################
+# Connection pool defaults, overridden by the "pool" dictionary of the
+# database configuration. At most DEFAULT_POOL_MAX_SIZE connections are
+# open at once, and connections idle for DEFAULT_POOL_IDLE_TIMEOUT seconds
+# are closed unless that leaves fewer than DEFAULT_POOL_MIN_SIZE open.
+DEFAULT_POOL_MIN_SIZE = 1
+DEFAULT_POOL_MAX_SIZE = 20
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+
+######################################################################
+# Seconds after which a pooled connection is pinged again before use.
+DEFAULT_POOL_HEALTH_CHECK_INTERVAL = 30
+
+######################################################################
+# Seconds a checkout waits for a connection when `max_size` of them are
+# in use before raising `PoolTimeoutError`; None waits forever.
+DEFAULT_POOL_ACQUIRE_TIMEOUT = 30
 
 
 class SQLDatabase(Database):
@@ -49,14 +75,34 @@ class SQLDatabase(Database):
     # tables
     FINGERPRINTS_TABLENAME = "fingerprints"
     SONGS_TABLENAME = "songs"
+    SETTINGS_TABLENAME = "settings"
+    HASH_STATS_TABLENAME = "hash_stats"
+    # fingerprints of another format being built, see `change_hash_format`
+    MIGRATION_TABLENAME = "fingerprints_migration"
+    REPLACED_TABLENAME = "fingerprints_replaced"
+    # per-connection temporary table of the "join" query mode
+    QUERY_TABLENAME = "query_hashes"
 
     # fields
     FIELD_FINGERPRINTED = "fingerprinted"
+    FIELD_SETTING_NAME = "name"
+    FIELD_SETTING_VALUE = "value"
+    FIELD_POSTINGS = "postings"
+
+    # settings
+    SETTING_HASH_FORMAT = "hash_format"
+    SETTING_PROFILE = "profile"
+
+    # column type of the `hash` field for each fingerprint format
+    HASH_COLUMN_TYPES = {
+        FINGERPRINT_FORMAT_SHA1: "binary(10)",
+        FINGERPRINT_FORMAT_PACKED: "bigint",
+    }
 
     # creates
     CREATE_FINGERPRINTS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
-             `%s` binary(10) not null,
+             `%s` %%s not null,
              `%s` mediumint unsigned not null,
              `%s` int unsigned not null,
          INDEX (%s),
@@ -69,46 +115,174 @@ class SQLDatabase(Database):
         Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID
     )
 
+    CREATE_MIGRATION_TABLE = """
+        CREATE TABLE `%s` (
+             `%s` %%s not null,
+             `%s` mediumint unsigned not null,
+             `%s` int unsigned not null,
+         INDEX (%s),
+         UNIQUE KEY `unique_constraint` (%s, %s, %s),
+         FOREIGN KEY (%s) REFERENCES %s(%s) ON DELETE CASCADE
+    ) ENGINE=INNODB;""" % (
+        MIGRATION_TABLENAME, Database.FIELD_HASH,
+        Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
+        Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_HASH,
+        Database.FIELD_SONG_ID, SONGS_TABLENAME, Database.FIELD_SONG_ID
+    )
+
     CREATE_SONGS_TABLE = """
         CREATE TABLE IF NOT EXISTS `%s` (
             `%s` mediumint unsigned not null auto_increment,
             `%s` varchar(250) not null,
             `%s` tinyint default 0,
             `%s` binary(20) not null,
+            `%s` int unsigned not null default 0,
         PRIMARY KEY (`%s`),
         UNIQUE KEY `%s` (`%s`)
     ) ENGINE=INNODB;""" % (
         SONGS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, FIELD_FINGERPRINTED,
-        Database.FIELD_FILE_SHA1,
+        Database.FIELD_FILE_SHA1, Database.FIELD_TOTAL_HASHES,
         Database.FIELD_SONG_ID, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID,
     )
 
+    CREATE_SETTINGS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` varchar(64) not null,
+            `%s` varchar(250) not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        SETTINGS_TABLENAME, FIELD_SETTING_NAME, FIELD_SETTING_VALUE,
+        FIELD_SETTING_NAME,
+    )
+
+    # number of fingerprints stored per hash, for `stopped_hashes`
+    CREATE_HASH_STATS_TABLE = """
+        CREATE TABLE IF NOT EXISTS `%s` (
+            `%s` %%s not null,
+            `%s` int unsigned not null,
+        PRIMARY KEY (`%s`)
+    ) ENGINE=INNODB;""" % (
+        HASH_STATS_TABLENAME, Database.FIELD_HASH, FIELD_POSTINGS,
+        Database.FIELD_HASH,
+    )
+
     # inserts (ignores duplicates)
     INSERT_FINGERPRINT = """
         INSERT IGNORE INTO %s (%s, %s, %s) values
             (UNHEX(%%s), %%s, %%s);
     """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
 
+    INSERT_FINGERPRINT_PACKED = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values
+            (%%s, %%s, %%s);
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    INSERT_MIGRATION = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values
+            (UNHEX(%%s), %%s, %%s);
+    """ % (MIGRATION_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    INSERT_MIGRATION_PACKED = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values
+            (%%s, %%s, %%s);
+    """ % (MIGRATION_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    # bulk inserts, see INSERT_MODES
+    INSERT_FINGERPRINTS_VALUES = """
+        INSERT IGNORE INTO %s (%s, %s, %s) values %%s;
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET)
+
+    LOAD_FINGERPRINTS = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s (@hash, %s, %s)
+        SET %s = UNHEX(@hash);
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           Database.FIELD_HASH)
+
+    LOAD_FINGERPRINTS_PACKED = """
+        LOAD DATA LOCAL INFILE %%s IGNORE INTO TABLE %s (%s, %s, %s);
+    """ % (FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_SONG_ID,
+           Database.FIELD_OFFSET)
+
+    UPDATE_HASH_STATS_VALUES = """
+        INSERT INTO %s (%s, %s) values %%s
+        ON DUPLICATE KEY UPDATE %s = %s + VALUES(%s);
+    """ % (HASH_STATS_TABLENAME, Database.FIELD_HASH, FIELD_POSTINGS,
+           FIELD_POSTINGS, FIELD_POSTINGS, FIELD_POSTINGS)
+
+    # exact counts of some hashes, whatever the statistics said before
+    RECOUNT_HASH_STATS = """
+        INSERT INTO %s (%s, %s)
+        SELECT %s, COUNT(*) FROM %s WHERE %s IN (%%s) GROUP BY %s
+        ON DUPLICATE KEY UPDATE %s = VALUES(%s);
+    """ % (HASH_STATS_TABLENAME, Database.FIELD_HASH, FIELD_POSTINGS,
+           Database.FIELD_HASH, FINGERPRINTS_TABLENAME, Database.FIELD_HASH,
+           Database.FIELD_HASH, FIELD_POSTINGS, FIELD_POSTINGS)
+
+    INSERT_ALL_HASH_STATS = """
+        INSERT INTO %s (%s, %s)
+        SELECT %s, COUNT(*) FROM %s GROUP BY %s;
+    """ % (HASH_STATS_TABLENAME, Database.FIELD_HASH, FIELD_POSTINGS,
+           Database.FIELD_HASH, FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
     INSERT_SONG = "INSERT INTO %s (%s, %s) values (%%s, UNHEX(%%s));" % (
         SONGS_TABLENAME, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1)
 
+    UPDATE_SETTING = """
+        INSERT INTO %s (%s, %s) values (%%s, %%s)
+        ON DUPLICATE KEY UPDATE %s = VALUES(%s);
+    """ % (SETTINGS_TABLENAME, FIELD_SETTING_NAME, FIELD_SETTING_VALUE,
+           FIELD_SETTING_VALUE, FIELD_SETTING_VALUE)
+
     # selects
     SELECT = """
         SELECT %s, %s FROM %s WHERE %s = UNHEX(%%s);
     """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
 
+    SELECT_PACKED = """
+        SELECT %s, %s FROM %s WHERE %s = %%s;
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
     SELECT_MULTIPLE = """
         SELECT HEX(%s), %s, %s FROM %s WHERE %s IN (%%s);
     """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
            FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
 
+    SELECT_MULTIPLE_PACKED = """
+        SELECT %s, %s, %s FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET,
+           FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
+    SELECT_HASH_COUNTS = """
+        SELECT HEX(%s), %s FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_HASH, FIELD_POSTINGS, HASH_STATS_TABLENAME,
+           Database.FIELD_HASH)
+
+    SELECT_HASH_COUNTS_PACKED = """
+        SELECT %s, %s FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_HASH, FIELD_POSTINGS, HASH_STATS_TABLENAME,
+           Database.FIELD_HASH)
+
     SELECT_ALL = """
         SELECT %s, %s FROM %s;
     """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME)
 
+    SELECT_ALL_FINGERPRINTS = """
+        SELECT LOWER(HEX(%s)), %s, %s FROM %s;
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
+    SELECT_ALL_FINGERPRINTS_PACKED = """
+        SELECT %s, %s, %s FROM %s;
+    """ % (Database.FIELD_HASH, Database.FIELD_SONG_ID, Database.FIELD_OFFSET, FINGERPRINTS_TABLENAME)
+
     SELECT_SONG = """
-        SELECT %s, HEX(%s) as %s FROM %s WHERE %s = %%s;
-    """ % (Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1, SONGS_TABLENAME, Database.FIELD_SONG_ID)
+        SELECT %s, HEX(%s) as %s, %s FROM %s WHERE %s = %%s;
+    """ % (Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1, Database.FIELD_TOTAL_HASHES,
+           SONGS_TABLENAME, Database.FIELD_SONG_ID)
+
+    SELECT_SONGS_BY_IDS = """
+        SELECT %s, %s, HEX(%s) as %s, %s FROM %s WHERE %s IN (%%s);
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1,
+           Database.FIELD_TOTAL_HASHES, SONGS_TABLENAME, Database.FIELD_SONG_ID)
 
     SELECT_NUM_FINGERPRINTS = """
         SELECT COUNT(*) as n FROM %s
@@ -123,29 +297,152 @@ class SQLDatabase(Database):
     """ % (Database.FIELD_SONG_ID, Database.FIELD_SONGNAME, Database.FIELD_FILE_SHA1, Database.FIELD_FILE_SHA1,
            SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
+    SELECT_SETTING = """
+        SELECT %s FROM %s WHERE %s = %%s;
+    """ % (FIELD_SETTING_VALUE, SETTINGS_TABLENAME, FIELD_SETTING_NAME)
+
+    SHOW_FINGERPRINTS_TABLE = "SHOW TABLES LIKE '%s';" % FINGERPRINTS_TABLENAME
+
+    SHOW_HASH_STATS_TABLE = "SHOW TABLES LIKE '%s';" % HASH_STATS_TABLENAME
+
+    SHOW_TOTAL_HASHES_COLUMN = "SHOW COLUMNS FROM %s LIKE '%s';" % (
+        SONGS_TABLENAME, Database.FIELD_TOTAL_HASHES)
+
+    # alters (for songs tables created before `total_hashes` existed)
+    ADD_TOTAL_HASHES_COLUMN = """
+        ALTER TABLE %s ADD COLUMN `%s` int unsigned not null default 0;
+    """ % (SONGS_TABLENAME, Database.FIELD_TOTAL_HASHES)
+
+    UPDATE_ALL_TOTAL_HASHES = """
+        UPDATE %s SET %s = (
+            SELECT COUNT(*) FROM %s WHERE %s.%s = %s.%s
+        );
+    """ % (SONGS_TABLENAME, Database.FIELD_TOTAL_HASHES, FINGERPRINTS_TABLENAME,
+           FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID,
+           SONGS_TABLENAME, Database.FIELD_SONG_ID)
+
+    # query table of the "join" query mode: the (hash, offset) pairs of one
+    # recording, joined with the fingerprints and grouped into
+    # (song_id, offset_difference) counts by the server
+    CREATE_QUERY_TABLE = """
+        CREATE TEMPORARY TABLE IF NOT EXISTS `%s` (
+            `%s` %%s not null,
+            `%s` int not null,
+        INDEX (%s)
+    ) ENGINE=MEMORY;""" % (
+        QUERY_TABLENAME, Database.FIELD_HASH, Database.FIELD_OFFSET,
+        Database.FIELD_HASH,
+    )
+
+    CLEAR_QUERY_TABLE = "DELETE FROM %s;" % QUERY_TABLENAME
+
+    INSERT_QUERY_VALUES = "INSERT INTO %s (%s, %s) values %%s;" % (
+        QUERY_TABLENAME, Database.FIELD_HASH, Database.FIELD_OFFSET)
+
+    # the query offset is signed, so the difference is too
+    SELECT_GROUPED_MATCHES = """
+        SELECT f.%s, CAST(f.%s AS SIGNED) - q.%s AS diff, COUNT(*) AS count
+        FROM %s f JOIN %s q ON f.%s = q.%s
+        GROUP BY f.%s, diff ORDER BY count DESC LIMIT %%s;
+    """ % (Database.FIELD_SONG_ID, Database.FIELD_OFFSET, Database.FIELD_OFFSET,
+           FINGERPRINTS_TABLENAME, QUERY_TABLENAME, Database.FIELD_HASH,
+           Database.FIELD_HASH, Database.FIELD_SONG_ID)
+
+    # the plain hash index, which bulk loads can defer; it is the only
+    # index starting with the hash, so lookups by hash scan the whole
+    # table while it is missing
+    SHOW_HASH_INDEX = "SHOW INDEX FROM %s WHERE Key_name = '%s';" % (
+        FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
+    DROP_HASH_INDEX = "ALTER TABLE %s DROP INDEX `%s`;" % (
+        FINGERPRINTS_TABLENAME, Database.FIELD_HASH)
+
+    ADD_HASH_INDEX = "ALTER TABLE %s ADD INDEX `%s` (%s);" % (
+        FINGERPRINTS_TABLENAME, Database.FIELD_HASH, Database.FIELD_HASH)
+
     # drops
     DROP_FINGERPRINTS = "DROP TABLE IF EXISTS %s;" % FINGERPRINTS_TABLENAME
     DROP_SONGS = "DROP TABLE IF EXISTS %s;" % SONGS_TABLENAME
+    DROP_HASH_STATS = "DROP TABLE IF EXISTS %s;" % HASH_STATS_TABLENAME
+    DROP_MIGRATION = "DROP TABLE IF EXISTS %s;" % MIGRATION_TABLENAME
+    DROP_REPLACED = "DROP TABLE IF EXISTS %s;" % REPLACED_TABLENAME
+
+    # renames, both at once
+    SWAP_MIGRATION = "RENAME TABLE %s TO %s, %s TO %s;" % (
+        FINGERPRINTS_TABLENAME, REPLACED_TABLENAME,
+        MIGRATION_TABLENAME, FINGERPRINTS_TABLENAME)
 
     # update
     UPDATE_SONG_FINGERPRINTED = """
-        UPDATE %s SET %s = 1 WHERE %s = %%s
-    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, Database.FIELD_SONG_ID)
+        UPDATE %s SET %s = 1, %s = (
+            SELECT COUNT(*) FROM %s WHERE %s = %%s
+        ) WHERE %s = %%s
+    """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED, Database.FIELD_TOTAL_HASHES,
+           FINGERPRINTS_TABLENAME, Database.FIELD_SONG_ID, Database.FIELD_SONG_ID)
 
     # delete
     DELETE_UNFINGERPRINTED = """
         DELETE FROM %s WHERE %s = 0;
     """ % (SONGS_TABLENAME, FIELD_FINGERPRINTED)
 
-    def __init__(self, **options):
+    CLEAR_HASH_STATS = "DELETE FROM %s;" % HASH_STATS_TABLENAME
+
+    # ways of inserting fingerprints: one executemany of single-row
+    # INSERTs, multi-row INSERT ... VALUES statements of VALUES_ROWS rows,
+    # or streaming them to the server with LOAD DATA LOCAL INFILE
+    INSERT_MODE_EXECUTEMANY = "executemany"
+    INSERT_MODE_VALUES = "values"
+    INSERT_MODE_LOAD_DATA = "load_data"
+    INSERT_MODES = (INSERT_MODE_EXECUTEMANY, INSERT_MODE_VALUES,
+                    INSERT_MODE_LOAD_DATA)
+    VALUES_ROWS = 10000
+
+    # ways of matching: SELECT ... IN lists of hashes, resolving offsets in
+    # Python, or a server-side join with a temporary table of the query
+    # that only returns the JOIN_MATCH_ROWS largest (song_id, diff) groups
+    QUERY_MODE_IN = "in"
+    QUERY_MODE_JOIN = "join"
+    QUERY_MODES = (QUERY_MODE_IN, QUERY_MODE_JOIN)
+    JOIN_MATCH_ROWS = 1000
+
+    def __init__(self, hash_format=None, pool=None,
+                 insert_mode=INSERT_MODE_EXECUTEMANY, defer_indexes=False,
+                 query_mode=QUERY_MODE_IN, stop_frequency=None, profile=None,
+                 **options):
         super(SQLDatabase, self).__init__()
-        self.cursor = cursor_factory(**options)
+        if hash_format is not None and hash_format not in FINGERPRINT_FORMATS:
+            raise ValueError("Unsupported fingerprint format: %r" % hash_format)
+        if insert_mode not in self.INSERT_MODES:
+            raise ValueError("Unsupported insert mode: %r" % insert_mode)
+        if query_mode not in self.QUERY_MODES:
+            raise ValueError("Unsupported query mode: %r" % query_mode)
+
+        self.insert_mode = insert_mode
+        self.query_mode = query_mode
+        self.defer_indexes = defer_indexes
+        self.stop_frequency = stop_frequency
+        # hash statistics are recounted by `end_bulk_load` instead
+        self._defer_stats = False
+        if insert_mode == self.INSERT_MODE_LOAD_DATA:
+            # the client refuses LOAD DATA LOCAL unless enabled
+            options.setdefault("local_infile", 1)
         self._options = options
+        self._pool_options = pool or {}
+        self.pool = ConnectionPool(**dict(self._pool_options, **options))
+        self.cursor = cursor_factory(self.pool)
+        # None means use whatever format the database already holds
+        self._configured_hash_format = hash_format
+        if hash_format is not None:
+            self.hash_format = hash_format
+        # likewise for the analysis profile
+        self._configured_profile = (get_profile(profile)
+                                    if profile is not None else None)
+        self.profile = get_profile(profile)
 
     def after_fork(self):
-        # Clear the cursor cache, we don't want any stale connections from
-        # the previous process.
-        Cursor.clear_cache()
+        # Clear the connection pool, we don't want any stale connections
+        # from the previous process.
+        self.pool.clear()
 
     def setup(self):
         """
@@ -154,22 +451,155 @@ class SQLDatabase(Database):
         This also removes all songs that have been added but have no
         fingerprints associated with them.
         """
+        self.pool.fill()
         with self.cursor() as cur:
             cur.execute(self.CREATE_SONGS_TABLE)
-            cur.execute(self.CREATE_FINGERPRINTS_TABLE)
+            cur.execute(self.CREATE_SETTINGS_TABLE)
+            self.hash_format = self._read_hash_format(cur)
+            self.profile = self._read_profile(cur)
+            cur.execute(self.CREATE_FINGERPRINTS_TABLE %
+                        self.HASH_COLUMN_TYPES[self.hash_format])
+            cur.execute(self.SHOW_HASH_INDEX)
+            if not cur.fetchone():
+                # a bulk load that never reached `end_bulk_load`
+                cur.execute(self.ADD_HASH_INDEX)
+            cur.execute(self.SHOW_HASH_STATS_TABLE)
+            if not cur.fetchone():
+                # count the fingerprints of databases created before
+                # statistics were kept
+                cur.execute(self.CREATE_HASH_STATS_TABLE %
+                            self.HASH_COLUMN_TYPES[self.hash_format])
+                cur.execute(self.INSERT_ALL_HASH_STATS)
+            cur.execute(self.SHOW_TOTAL_HASHES_COLUMN)
+            if not cur.fetchone():
+                cur.execute(self.ADD_TOTAL_HASHES_COLUMN)
+                cur.execute(self.UPDATE_ALL_TOTAL_HASHES)
             cur.execute(self.DELETE_UNFINGERPRINTED)
 
+    def _read_hash_format(self, cur):
+        """
+        Returns the fingerprint format recorded in the database, recording
+        the configured one if this is a new database.
+        """
+        cur.execute(self.SELECT_SETTING, (self.SETTING_HASH_FORMAT,))
+        row = cur.fetchone()
+        if row:
+            stored, = row
+        else:
+            # fingerprint tables created before the format was recorded
+            # always hold sha1 hashes
+            cur.execute(self.SHOW_FINGERPRINTS_TABLE)
+            if cur.fetchone():
+                stored = FINGERPRINT_FORMAT_SHA1
+            else:
+                stored = self.hash_format
+            cur.execute(self.UPDATE_SETTING,
+                        (self.SETTING_HASH_FORMAT, stored))
+
+        configured = self._configured_hash_format
+        if configured is not None and configured != stored:
+            raise ValueError("Database holds %r fingerprints but %r was "
+                             "configured, migrate it first with "
+                             "`dejavu.py --migrate-format`." %
+                             (stored, configured))
+        return stored
+
+    def _read_profile(self, cur):
+        """
+        Returns the analysis profile recorded in the database, recording
+        the configured one if this is a new database.
+        """
+        cur.execute(self.SELECT_SETTING, (self.SETTING_PROFILE,))
+        row = cur.fetchone()
+        if row:
+            stored = get_profile(json.loads(row[0]))
+        else:
+            # fingerprints stored before the profile was recorded were
+            # all computed at full rate
+            cur.execute(self.SHOW_FINGERPRINTS_TABLE)
+            if cur.fetchone():
+                stored = get_profile(PROFILE_FULL)
+            else:
+                stored = self.profile
+            cur.execute(self.UPDATE_SETTING,
+                        (self.SETTING_PROFILE,
+                         json.dumps(stored, sort_keys=True)))
+
+        configured = self._configured_profile
+        if configured is not None and configured != stored:
+            raise ValueError("Database was fingerprinted with the %r "
+                             "profile but %r was configured, empty it "
+                             "first to fingerprint with another one." %
+                             (stored, configured))
+        return stored
+
+    def change_hash_format(self, hash_format, songs):
+        """
+        Switches the database to another fingerprint format, given the
+        fingerprints of every song again in that format (see
+        `Dejavu.migrate_hash_format`).
+
+        `songs` yields (song_id, hashes) pairs. They are inserted into a
+        new table that replaces the fingerprints table once all of them
+        are; if anything fails before, the new table is dropped and the
+        database is left as it was.
+        """
+        if hash_format not in FINGERPRINT_FORMATS:
+            raise ValueError("Unsupported fingerprint format: %r" % hash_format)
+
+        if hash_format == FINGERPRINT_FORMAT_PACKED:
+            query = self.INSERT_MIGRATION_PACKED
+        else:
+            query = self.INSERT_MIGRATION
+
+        with self.cursor() as cur:
+            # left over by a migration that was killed
+            cur.execute(self.DROP_MIGRATION)
+            cur.execute(self.CREATE_MIGRATION_TABLE %
+                        self.HASH_COLUMN_TYPES[hash_format])
+        try:
+            for sid, hashes in songs:
+                with self.cursor() as cur:
+                    values = ((hash, sid, offset) for hash, offset in hashes)
+                    for split_values in grouper(values, 1000):
+                        cur.executemany(query, split_values)
+        except Exception:
+            with self.cursor() as cur:
+                cur.execute(self.DROP_MIGRATION)
+            raise
+
+        with self.cursor() as cur:
+            # `setup` counts them again if this doesn't get to finish
+            cur.execute(self.DROP_HASH_STATS)
+            cur.execute(self.SWAP_MIGRATION)
+            cur.execute(self.UPDATE_SETTING,
+                        (self.SETTING_HASH_FORMAT, hash_format))
+            cur.execute(self.DROP_REPLACED)
+            cur.execute(self.CREATE_HASH_STATS_TABLE %
+                        self.HASH_COLUMN_TYPES[hash_format])
+            cur.execute(self.INSERT_ALL_HASH_STATS)
+            cur.execute(self.UPDATE_ALL_TOTAL_HASHES)
+
+        self.hash_format = hash_format
+        self._configured_hash_format = hash_format
+
     def empty(self):
         """
         Drops tables created by dejavu and then creates them again
-        by calling `SQLDatabase.setup`.
+        by calling `SQLDatabase.setup`. The recorded fingerprint format
+        is kept, the configured analysis profile, if any, is recorded.
 
         .. warning:
             This will result in a loss of data
         """
+        profile = self._configured_profile or self.profile
         with self.cursor() as cur:
             cur.execute(self.DROP_FINGERPRINTS)
             cur.execute(self.DROP_SONGS)
+            cur.execute(self.DROP_HASH_STATS)
+            cur.execute(self.UPDATE_SETTING,
+                        (self.SETTING_PROFILE,
+                         json.dumps(profile, sort_keys=True)))
 
         self.setup()
 
@@ -184,7 +614,7 @@ class SQLDatabase(Database):
         """
         Returns number of songs the database has fingerprinted.
         """
-        with self.cursor() as cur:
+        with self.cursor(read_only=True) as cur:
             cur.execute(self.SELECT_UNIQUE_SONG_IDS)
 
             for count, in cur:
@@ -195,7 +625,7 @@ class SQLDatabase(Database):
         """
         Returns number of fingerprints the database has fingerprinted.
         """
-        with self.cursor() as cur:
+        with self.cursor(read_only=True) as cur:
             cur.execute(self.SELECT_NUM_FINGERPRINTS)
 
             for count, in cur:
@@ -205,16 +635,16 @@ class SQLDatabase(Database):
     def set_song_fingerprinted(self, sid):
         """
         Set the fingerprinted flag to TRUE (1) once a song has been completely
-        fingerprinted in the database.
+        fingerprinted in the database, and store its number of fingerprints.
         """
         with self.cursor() as cur:
-            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid,))
+            cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid, sid))
 
     def get_songs(self):
         """
         Return songs that have the fingerprinted flag set TRUE (1).
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
+        with self.cursor(read_only=True, cursor_type=DictCursor) as cur:
             cur.execute(self.SELECT_SONGS)
             for row in cur:
                 yield row
@@ -223,16 +653,34 @@ class SQLDatabase(Database):
         """
         Returns song by its ID.
         """
-        with self.cursor(cursor_type=DictCursor) as cur:
+        with self.cursor(read_only=True, cursor_type=DictCursor) as cur:
             cur.execute(self.SELECT_SONG, (sid,))
             return cur.fetchone()
 
+    def get_songs_by_ids(self, sids):
+        """
+        Returns a dictionary of song ID => song for the given IDs.
+        """
+        songs = {}
+        with self.cursor(read_only=True, cursor_type=DictCursor) as cur:
+            for split_values in grouper(sids, 1000):
+                query = self.SELECT_SONGS_BY_IDS
+                query = query % ', '.join(['%s'] * len(split_values))
+
+                cur.execute(query, split_values)
+                for row in cur:
+                    songs[row.pop(Database.FIELD_SONG_ID)] = row
+        return songs
+
     def insert(self, hash, sid, offset):
         """
         Insert a (sha1, song_id, offset) row into database.
         """
         with self.cursor() as cur:
-            cur.execute(self.INSERT_FINGERPRINT, (hash, sid, offset))
+            cur.execute(self._insert_fingerprint_query(), (hash, sid, offset))
+            inserted = cur.rowcount
+        if not self._defer_stats:
+            self._update_hash_stats(({hash: inserted}, set()))
 
     def insert_song(self, songname, file_hash):
         """
@@ -250,64 +698,371 @@ class SQLDatabase(Database):
         database (be careful with that one!).
         """
         # select all if no key
-        query = self.SELECT_ALL if hash is None else self.SELECT
+        if hash is None:
+            query, args = self.SELECT_ALL, None
+        elif self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            query, args = self.SELECT_PACKED, (hash,)
+        else:
+            query, args = self.SELECT, (hash,)
 
-        with self.cursor() as cur:
-            cur.execute(query)
+        with self.cursor(read_only=True) as cur:
+            cur.execute(query, args)
             for sid, offset in cur:
                 yield (sid, offset)
 
     def get_iterable_kv_pairs(self):
         """
-        Returns all tuples in database.
+        Returns all (hash, song_id, offset) tuples in database, streamed
+        from the server rather than loaded at once.
         """
-        return self.query(None)
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            query = self.SELECT_ALL_FINGERPRINTS_PACKED
+        else:
+            query = self.SELECT_ALL_FINGERPRINTS
+
+        with self.cursor(read_only=True, cursor_type=SSCursor) as cur:
+            cur.execute(query)
+            for hash, sid, offset in cur:
+                yield (hash, sid, offset)
 
     def insert_hashes(self, sid, hashes):
         """
         Insert series of hash => song_id, offset
         values into the database.
         """
-        values = []
-        for hash, offset in hashes:
-            values.append((hash, sid, offset))
+        values = ((hash, sid, offset) for hash, offset in hashes)
 
         with self.cursor() as cur:
+            stats = self._insert_fingerprints(cur, values)
+        self._update_hash_stats(stats)
+
+    def insert_songs(self, songs):
+        """
+        Insert songs together with all their fingerprints, in a single
+        transaction, and mark them as fingerprinted.
+        """
+        sids = []
+        with self.cursor() as cur:
+            for song_name, file_hash, _ in songs:
+                cur.execute(self.INSERT_SONG, (song_name, file_hash))
+                sids.append(cur.lastrowid)
+
+            values = ((hash, sid, offset)
+                      for sid, (_, _, hashes) in izip(sids, songs)
+                      for hash, offset in hashes)
+            stats = self._insert_fingerprints(cur, values)
+
+            for sid in sids:
+                cur.execute(self.UPDATE_SONG_FINGERPRINTED, (sid, sid))
+        self._update_hash_stats(stats)
+        return sids
+
+    def _insert_fingerprints(self, cur, values):
+        """
+        Inserts (hash, song_id, offset) rows, as `insert_mode` says.
+
+        returns: the change to the hash statistics for
+        `_update_hash_stats`, None while they are deferred
+        """
+        counts = defaultdict(int)
+        # hashes of batches in which the insert ignored duplicates; the
+        # row count says how many rows were new, not which ones
+        recount = set()
+
+        def tally(batch_counts, inserted):
+            if self._defer_stats:
+                return
+            if inserted == sum(batch_counts.itervalues()):
+                for hash, count in batch_counts.iteritems():
+                    counts[hash] += count
+            else:
+                recount.update(batch_counts)
+
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            row = '(%s, %s, %s)'
+        else:
+            row = '(UNHEX(%s), %s, %s)'
+
+        if self.insert_mode == self.INSERT_MODE_LOAD_DATA:
+            batch_counts = defaultdict(int)
+            self._load_fingerprints(cur, _count_hashes(values, batch_counts))
+            tally(batch_counts, cur.rowcount)
+        elif self.insert_mode == self.INSERT_MODE_VALUES:
+            for split_values in grouper(values, self.VALUES_ROWS):
+                query = self.INSERT_FINGERPRINTS_VALUES % ', '.join(
+                    [row] * len(split_values))
+                cur.execute(query, [field for value in split_values
+                                    for field in value])
+                tally(_hash_counts(split_values), cur.rowcount)
+        else:
+            query = self._insert_fingerprint_query()
             for split_values in grouper(values, 1000):
-                cur.executemany(self.INSERT_FINGERPRINT, split_values)
-                cur.connection.commit()
+                cur.executemany(query, split_values)
+                tally(_hash_counts(split_values), cur.rowcount)
+
+        if self._defer_stats:
+            return None
+        return counts, recount
+
+    def _update_hash_stats(self, stats):
+        """
+        Applies a (counts, recount) change of `_insert_fingerprints` to
+        the hash statistics: adds a dictionary of hash => number of new
+        fingerprints and recounts a set of hashes exactly.
+
+        This is its own short transaction, after the fingerprints were
+        committed, so writers only hold the locks of the frequent hashes
+        they share for a moment.
+        """
+        if stats is None:
+            return
+        counts, recount = stats
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            row, key = '(%s, %s)', '%s'
+        else:
+            row, key = '(UNHEX(%s), %s)', 'UNHEX(%s)'
+
+        # recounts include the rows the counts are about
+        added = sorted((hash, count) for hash, count in counts.iteritems()
+                       if count and hash not in recount)
+
+        with self.cursor() as cur:
+            # always in hash order, so concurrent writers lock rows in the
+            # same order rather than deadlocking
+            for split_values in grouper(added, self.VALUES_ROWS):
+                query = self.UPDATE_HASH_STATS_VALUES % ', '.join(
+                    [row] * len(split_values))
+                cur.execute(query, [field for value in split_values
+                                    for field in value])
+
+            for split_values in grouper(sorted(recount), self.VALUES_ROWS):
+                query = self.RECOUNT_HASH_STATS % ', '.join(
+                    [key] * len(split_values))
+                cur.execute(query, split_values)
+
+    def rebuild_hash_stats(self):
+        """
+        Recounts the hash statistics from the fingerprints, e.g. after
+        songs were removed, which doesn't update them.
+        """
+        with self.cursor() as cur:
+            cur.execute(self.CLEAR_HASH_STATS)
+            cur.execute(self.INSERT_ALL_HASH_STATS)
+
+    def _load_fingerprints(self, cur, values):
+        """
+        Streams rows to a temporary tab separated file and loads it with
+        LOAD DATA LOCAL INFILE.
+        """
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            query = self.LOAD_FINGERPRINTS_PACKED
+        else:
+            query = self.LOAD_FINGERPRINTS
+
+        with tempfile.NamedTemporaryFile(prefix="dejavu-",
+                                         suffix=".tsv") as f:
+            for value in values:
+                f.write("%s\t%d\t%d\n" % value)
+            f.flush()
+            cur.execute(query, (f.name,))
+
+    def begin_bulk_load(self):
+        """
+        Drops the hash index when `defer_indexes` is set, it is rebuilt in
+        one sorted pass by `end_bulk_load` rather than maintained row by
+        row. The hash statistics are likewise recounted once at the end.
+
+        .. warning:
+            No other index starts with the hash, so until the load ends
+            every lookup by hash scans the whole fingerprints table;
+            don't recognize while bulk loading. If the load never ends,
+            e.g. because the process was killed, the next `setup`
+            restores the index.
+        """
+        if not self.defer_indexes:
+            return
+        self._defer_stats = True
+        with self.cursor() as cur:
+            cur.execute(self.SHOW_HASH_INDEX)
+            if cur.fetchone():
+                cur.execute(self.DROP_HASH_INDEX)
+
+    def end_bulk_load(self):
+        """
+        Rebuilds the hash index dropped by `begin_bulk_load` and the
+        hash statistics.
+        """
+        if not self.defer_indexes:
+            return
+        with self.cursor() as cur:
+            cur.execute(self.SHOW_HASH_INDEX)
+            if not cur.fetchone():
+                cur.execute(self.ADD_HASH_INDEX)
+        self.rebuild_hash_stats()
+        self._defer_stats = False
+
+    def _insert_fingerprint_query(self):
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            return self.INSERT_FINGERPRINT_PACKED
+        return self.INSERT_FINGERPRINT
 
     def return_matches(self, hashes):
         """
         Return the (song_id, offset_diff) tuples associated with
         a list of (sha1, sample_offset) values.
         """
-        # Create a dictionary of hash => offset pairs for later lookups
-        mapper = {}
-        for hash, offset in hashes:
-            mapper[hash.upper()] = offset
+        sids, diffs = self.return_match_arrays(hashes)
+        for sid, diff in zip(sids.tolist(), diffs.tolist()):
+            # (sid, db_offset - song_sampled_offset)
+            yield (sid, diff)
 
-        # Get an iterable of all the hashes we need
-        values = mapper.keys()
+    def return_match_arrays(self, hashes):
+        """
+        Return the song ids and offset differences associated with
+        a list of (hash, sample_offset) values, as two arrays, looked up
+        as `query_mode` says.
+        """
+        if self.query_mode != self.QUERY_MODE_JOIN:
+            return super(SQLDatabase, self).return_match_arrays(hashes)
+
+        groups = np.array(self.return_grouped_matches(hashes),
+                          dtype=np.int64).reshape(-1, 3)
+        return (np.repeat(groups[:, 0], groups[:, 2]),
+                np.repeat(groups[:, 1], groups[:, 2]))
+
+    def return_segment_match_arrays(self, segments):
+        """
+        In the "join" query mode every list is matched by the server on
+        its own; otherwise see `Database.return_segment_match_arrays`.
+        """
+        if self.query_mode != self.QUERY_MODE_JOIN:
+            return super(SQLDatabase, self).return_segment_match_arrays(
+                segments)
+        return [self.return_match_arrays(hashes) for hashes in segments]
+
+    def return_grouped_matches(self, hashes):
+        """
+        Matches a list of (hash, sample_offset) values on the server,
+        through a temporary table holding every one of them, including
+        repeated hashes.
+
+        returns: list of the JOIN_MATCH_ROWS (song_id, offset_diff, count)
+        groups with the highest counts, highest first
+        """
+        hashes = list(hashes)
+        stopped = self.stopped_hashes(list(set(hash for hash, _ in hashes)))
+        if stopped:
+            hashes = [(hash, offset) for hash, offset in hashes
+                      if hash not in stopped]
+
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            row = '(%s, %s)'
+        else:
+            row = '(UNHEX(%s), %s)'
 
         with self.cursor() as cur:
-            for split_values in grouper(values, 1000):
+            cur.execute(self.CREATE_QUERY_TABLE %
+                        self.HASH_COLUMN_TYPES[self.hash_format])
+            # the table lives as long as the pooled connection
+            cur.execute(self.CLEAR_QUERY_TABLE)
+            for split_values in grouper(hashes, self.VALUES_ROWS):
+                query = self.INSERT_QUERY_VALUES % ', '.join(
+                    [row] * len(split_values))
+                cur.execute(query, [field for value in split_values
+                                    for field in value])
+
+            cur.execute(self.SELECT_GROUPED_MATCHES, (self.JOIN_MATCH_ROWS,))
+            groups = [(sid, int(diff), int(count))
+                      for sid, diff, count in cur]
+            cur.execute(self.CLEAR_QUERY_TABLE)
+        return groups
+
+    def return_postings(self, hashes):
+        """
+        Looks up a list of distinct hashes with as few queries as
+        `return_matches` needs for a single list.
+
+        returns: (owner, sids, offsets) int64 arrays, `owner` being the
+        index in `hashes` of each posting's hash
+        """
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            index = dict((hash, i) for i, hash in enumerate(hashes))
+            select, placeholder = self.SELECT_MULTIPLE_PACKED, '%s'
+        else:
+            index = dict((hash.upper(), i) for i, hash in enumerate(hashes))
+            select, placeholder = self.SELECT_MULTIPLE, 'UNHEX(%s)'
+
+        postings = []
+        with self.cursor(read_only=True) as cur:
+            for split_values in grouper(index.keys(), 1000):
                 # Create our IN part of the query
-                query = self.SELECT_MULTIPLE
-                query = query % ', '.join(['UNHEX(%s)'] * len(split_values))
+                query = select % ', '.join([placeholder] * len(split_values))
 
                 cur.execute(query, split_values)
 
                 for hash, sid, offset in cur:
-                    # (sid, db_offset - song_sampled_offset)
-                    yield (sid, offset - mapper[hash])
+                    postings.append((index[hash], sid, offset))
+
+        postings = np.array(postings, dtype=np.int64).reshape(-1, 3)
+        return postings[:, 0], postings[:, 1], postings[:, 2]
+
+    def return_hash_counts(self, hashes):
+        """
+        Returns the number of postings of each hash, read from the hash
+        statistics rather than by counting fingerprints.
+        """
+        if self.hash_format == FINGERPRINT_FORMAT_PACKED:
+            index = dict((hash, i) for i, hash in enumerate(hashes))
+            select, placeholder = self.SELECT_HASH_COUNTS_PACKED, '%s'
+        else:
+            index = dict((hash.upper(), i) for i, hash in enumerate(hashes))
+            select, placeholder = self.SELECT_HASH_COUNTS, 'UNHEX(%s)'
+
+        counts = np.zeros(len(hashes), dtype=np.int64)
+        with self.cursor(read_only=True) as cur:
+            for split_values in grouper(index.keys(), 1000):
+                query = select % ', '.join([placeholder] * len(split_values))
+
+                cur.execute(query, split_values)
+
+                for hash, count in cur:
+                    counts[index[hash]] = count
+        return counts
 
     def __getstate__(self):
-        return (self._options,)
+        return (self._options, self._pool_options, self.hash_format,
+                self._configured_hash_format, self.insert_mode,
+                self.defer_indexes, self.query_mode, self.stop_frequency,
+                self.profile, self._configured_profile)
 
     def __setstate__(self, state):
-        self._options, = state
-        self.cursor = cursor_factory(**self._options)
+        (self._options, self._pool_options, self.hash_format,
+         self._configured_hash_format, self.insert_mode,
+         self.defer_indexes, self.query_mode, self.stop_frequency,
+         self.profile, self._configured_profile) = state
+        self._defer_stats = False
+        self.pool = ConnectionPool(**dict(self._pool_options, **self._options))
+        self.cursor = cursor_factory(self.pool)
+
+
+def _count_hashes(values, counts):
+    """
+    Passes (hash, song_id, offset) rows through, counting them per hash
+    in the dictionary `counts`.
+    """
+    for value in values:
+        counts[value[0]] += 1
+        yield value
+
+
+def _hash_counts(values):
+    """
+    Returns the number of (hash, song_id, offset) rows of every hash.
+    """
+    counts = defaultdict(int)
+    for value in values:
+        counts[value[0]] += 1
+    return counts
 
 
 def grouper(iterable, n, fillvalue=None):
@@ -316,59 +1071,255 @@ def grouper(iterable, n, fillvalue=None):
             in izip_longest(fillvalue=fillvalue, *args))
 
 
-def cursor_factory(**factory_options):
+def cursor_factory(pool):
     def cursor(**options):
-        options.update(factory_options)
-        return Cursor(**options)
+        return Cursor(pool, **options)
     return cursor
 
 
+class ConnectionPool(object):
+    """
+    Thread-safe pool of MySQL connections, `options` being the arguments
+    of `MySQLdb.connect`.
+
+    Up to `max_size` connections are open at once; checkouts beyond that
+    wait for a connection to be returned, for at most `acquire_timeout`
+    seconds before raising `PoolTimeoutError`. Connections left idle for more
+    than `idle_timeout` seconds are closed, except for `min_size` of them,
+    which `fill` opens ahead of time. Instead of pinging on every
+    checkout, a connection is only health-checked when it wasn't for
+    `health_check_interval` seconds; one that fails the check is replaced
+    by a new connection.
+    """
+
+    # counters reported by `stats`
+    STATS = ("checkouts", "creations", "closures", "health_checks", "waits",
+             "wait_time", "timeouts")
+
+    def __init__(self, min_size=DEFAULT_POOL_MIN_SIZE,
+                 max_size=DEFAULT_POOL_MAX_SIZE,
+                 idle_timeout=DEFAULT_POOL_IDLE_TIMEOUT,
+                 health_check_interval=DEFAULT_POOL_HEALTH_CHECK_INTERVAL,
+                 acquire_timeout=DEFAULT_POOL_ACQUIRE_TIMEOUT,
+                 **options):
+        super(ConnectionPool, self).__init__()
+        self.min_size = min_size
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_interval = health_check_interval
+        self.acquire_timeout = acquire_timeout
+        self.options = options
+
+        self._lock = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        # most recently returned last
+        self._idle = []
+        self._size = 0
+        self._stats = dict((name, 0) for name in self.STATS)
+
+    def fill(self):
+        """
+        Opens connections until `min_size` of them are open.
+        """
+        while True:
+            with self._lock:
+                if self._size >= self.min_size:
+                    return
+                self._size += 1
+            self.release(self._connect())
+
+    def acquire(self):
+        """
+        Checks a connection out of the pool.
+
+        returns: a `PooledConnection`, to be given back with `release`
+        """
+        with self._lock:
+            self._stats["checkouts"] += 1
+            if not self._idle and self._size >= self.max_size:
+                self._stats["waits"] += 1
+                start = time.time()
+                while not self._idle and self._size >= self.max_size:
+                    if self.acquire_timeout is None:
+                        self._lock.wait()
+                        continue
+                    remaining = start + self.acquire_timeout - time.time()
+                    if remaining <= 0:
+                        self._stats["wait_time"] += time.time() - start
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeoutError(
+                            "No connection was returned to the pool within "
+                            "%s seconds, all %d are in use." %
+                            (self.acquire_timeout, self.max_size))
+                    self._lock.wait(remaining)
+                self._stats["wait_time"] += time.time() - start
+
+            if self._idle:
+                connection = self._idle.pop()
+            else:
+                connection = None
+                self._size += 1
+
+        if connection is None:
+            return self._connect()
+
+        if time.time() - connection.checked > self.health_check_interval:
+            with self._lock:
+                self._stats["health_checks"] += 1
+            try:
+                # no reconnect, it would silently reset the session and
+                # its autocommit mode
+                connection.conn.ping()
+            except mysql.MySQLError:
+                # replace the connection the server closed, keeping its
+                # place in the pool
+                with self._lock:
+                    self._close(connection)
+                    self._size += 1
+                return self._connect()
+            connection.checked = time.time()
+        return connection
+
+    def release(self, connection, broken=False):
+        """
+        Returns a connection to the pool, closing it if `broken`.
+        """
+        now = time.time()
+        with self._lock:
+            if broken:
+                self._close(connection)
+            else:
+                connection.used = now
+                self._idle.append(connection)
+
+            # close connections idle for too long, oldest first
+            while (self._idle and self._size > self.min_size and
+                   now - self._idle[0].used > self.idle_timeout):
+                self._close(self._idle.pop(0))
+
+            self._lock.notify()
+
+    def clear(self):
+        """
+        Forgets all connections without closing them, for a new process
+        that mustn't use the connections of its parent.
+        """
+        with self._lock:
+            self._reset()
+
+    def stats(self):
+        """
+        Returns a dictionary of pool statistics for monitoring: the
+        current `size`, `idle` and `in_use` connections and the counters
+        of STATS since the pool was created, `wait_time` in seconds.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = self._size
+            stats["idle"] = len(self._idle)
+            stats["in_use"] = self._size - len(self._idle)
+            return stats
+
+    def _connect(self):
+        try:
+            conn = mysql.connect(**self.options)
+        except Exception:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+        with self._lock:
+            self._stats["creations"] += 1
+        return PooledConnection(conn)
+
+    def _close(self, connection):
+        # called with the lock held
+        self._size -= 1
+        self._stats["closures"] += 1
+        try:
+            connection.conn.close()
+        except mysql.MySQLError:
+            pass
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+class PooledConnection(object):
+    """
+    A connection of a `ConnectionPool` and its bookkeeping.
+    """
+
+    def __init__(self, conn):
+        super(PooledConnection, self).__init__()
+        self.conn = conn
+        self.checked = self.used = time.time()
+        # MySQLdb connections start with autocommit off
+        self.autocommit = False
+
+
 class Cursor(object):
     """
-    Establishes a connection to the database and returns an open cursor.
+    Checks a connection out of a `ConnectionPool` and returns an open
+    cursor.
+
+    Changes are committed on exit, or rolled back on errors. Read-only
+    cursors run in autocommit mode instead, so they skip the commit and
+    never leave a transaction open on a pooled connection.
 
+    The connection is only checked out on entering the block, so a
+    cursor that is never entered doesn't hold one.
 
     ```python
     # Use as context manager
-    with Cursor() as cur:
+    with Cursor(pool) as cur:
         cur.execute(query)
     ```
     """
-    _cache = Queue.Queue(maxsize=5)
 
-    def __init__(self, cursor_type=mysql.cursors.Cursor, **options):
+    def __init__(self, pool, cursor_type=mysql.cursors.Cursor,
+                 read_only=False):
         super(Cursor, self).__init__()
-
-        try:
-            conn = self._cache.get_nowait()
-        except Queue.Empty:
-            conn = mysql.connect(**options)
-        else:
-            # Ping the connection before using it from the cache.
-            conn.ping(True)
-
-        self.conn = conn
-        self.conn.autocommit(False)
+        self.pool = pool
+        self.read_only = read_only
         self.cursor_type = cursor_type
 
-    @classmethod
-    def clear_cache(cls):
-        cls._cache = Queue.Queue(maxsize=5)
-
     def __enter__(self):
-        self.cursor = self.conn.cursor(self.cursor_type)
+        self.connection = self.pool.acquire()
+        self.conn = self.connection.conn
+        try:
+            # only switch when needed, it costs a round trip
+            if self.connection.autocommit != self.read_only:
+                self.conn.autocommit(self.read_only)
+                self.connection.autocommit = self.read_only
+            self.cursor = self.conn.cursor(self.cursor_type)
+        except Exception:
+            self.pool.release(self.connection, broken=True)
+            raise
         return self.cursor
 
     def __exit__(self, extype, exvalue, traceback):
-        # if we had a MySQL related error we try to rollback the cursor.
-        if extype is mysql.MySQLError:
-            self.cursor.rollback()
-
-        self.cursor.close()
-        self.conn.commit()
-
-        # Put it back on the queue
+        broken = False
         try:
-            self._cache.put_nowait(self.conn)
-        except Queue.Full:
-            self.conn.close()
+            self.cursor.close()
+            if self.read_only:
+                pass
+            elif extype is None:
+                self.conn.commit()
+            else:
+                # roll back whatever the failed block changed
+                self.conn.rollback()
+        except mysql.MySQLError:
+            broken = True
+            if extype is None:
+                raise
+        finally:
+            # lost connections aren't put back
+            if extype is not None and issubclass(extype,
+                                                 mysql.OperationalError):
+                broken = True
+            self.pool.release(self.connection, broken=broken)
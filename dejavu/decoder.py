@@ -1,10 +1,18 @@
 import fnmatch
 import os
+import sqlite3
+import struct
+import threading
 from hashlib import sha1
 
 import numpy as np
+from pydub import AudioSegment
 from pydub.utils import audioop
 
+# WAV format tags of uncompressed integer PCM data
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
 
 def unique_hash(filepath, blocksize=2 ** 20):
     """ Small function to generate a hash to uniquely generate
@@ -23,6 +31,64 @@ def unique_hash(filepath, blocksize=2 ** 20):
     return s.hexdigest().upper()
 
 
+class HashCache(object):
+    """
+    Sidecar store of (path, size, mtime) => file SHA1, so files that
+    haven't changed since they were last seen aren't read again just to
+    find out they were already fingerprinted.
+
+    The store is a small SQLite file and may be shared between threads.
+    """
+    CREATE_TABLE = """
+        CREATE TABLE IF NOT EXISTS file_hashes (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL,
+            sha1 TEXT NOT NULL
+        );
+    """
+    SELECT_HASH = """
+        SELECT sha1 FROM file_hashes WHERE path = ? AND size = ? AND mtime = ?;
+    """
+    INSERT_HASH = """
+        INSERT OR REPLACE INTO file_hashes (path, size, mtime, sha1)
+        VALUES (?, ?, ?, ?);
+    """
+
+    def __init__(self, path):
+        super(HashCache, self).__init__()
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._conn.execute(self.CREATE_TABLE)
+            self._conn.commit()
+
+    def unique_hash(self, filepath):
+        """
+        Same as `unique_hash`, reusing the stored hash if the file's size
+        and modification time didn't change.
+        """
+        filepath = os.path.abspath(filepath)
+        stat = os.stat(filepath)
+        key = (filepath, stat.st_size, stat.st_mtime)
+
+        with self._lock:
+            row = self._conn.execute(self.SELECT_HASH, key).fetchone()
+        if row:
+            return str(row[0])
+
+        file_hash = unique_hash(filepath)
+        with self._lock:
+            self._conn.execute(self.INSERT_HASH, key + (file_hash,))
+            self._conn.commit()
+        return file_hash
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
 def find_files(path, extensions):
     # Allow both with ".mp3" and without "mp3" to be used for extensions
     extensions = [e.replace(".", "") for e in extensions]
@@ -34,10 +100,10 @@ def find_files(path, extensions):
                 yield (p, extension)
 
 
-def read(filename, audio_file):
+def read(filename, audio_file, file_hash=None):
     """
     Reads any file supported by pydub (ffmpeg) and returns the data contained
-    within.
+    within. `file_hash` skips hashing the file again if it's already known.
 
     returns: (channels, sample rate, filename hash)
     """
@@ -51,7 +117,128 @@ def read(filename, audio_file):
     except audioop.error:
         pass
 
-    return channels, audio_file.frame_rate, unique_hash(filename)
+    return channels, audio_file.frame_rate, file_hash or unique_hash(filename)
+
+
+def read_file(filename):
+    """
+    Reads an audio file, using `read_wav` for PCM WAV files and pydub
+    (ffmpeg) for everything else.
+
+    returns: (channels, sample rate)
+    """
+    wav = read_wav(filename)
+    if wav is not None:
+        return wav
+
+    audio_file = AudioSegment.from_file(filename)
+    channels = []
+    try:
+        data = np.fromstring(audio_file._data, np.int16)
+
+        for chn in xrange(audio_file.channels):
+            channels.append(data[chn::audio_file.channels])
+
+    except audioop.error:
+        pass
+
+    return channels, audio_file.frame_rate
+
+
+def read_wav(filename):
+    """
+    Reads an uncompressed 8, 16, 24 or 32 bit PCM WAV file without pydub
+    or ffmpeg, by memory-mapping its sample data. 16 bit channels are
+    zero-copy views into the mapping; other sample widths are converted
+    to the 16 bit range ffmpeg would have decoded them to.
+
+    returns: (channels, sample rate), or None if the file isn't a PCM
+    WAV file
+    """
+    info = wav_info(filename)
+    if info is None:
+        return None
+
+    nchannels, rate, sampwidth, offset, nframes = info
+    if not nframes:
+        return [np.zeros(0, dtype=np.int16)] * nchannels, rate
+
+    if sampwidth == 2:
+        data = np.memmap(filename, dtype='<i2', mode='r', offset=offset,
+                         shape=(nframes, nchannels))
+        return [data[:, chn] for chn in xrange(nchannels)], rate
+
+    if sampwidth == 3:
+        data = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                         shape=(nframes, nchannels, 3))
+        # the two most significant bytes of each little-endian sample
+        channels = [(data[:, chn, 2].astype(np.int8).astype(np.int16) << 8) |
+                    data[:, chn, 1]
+                    for chn in xrange(nchannels)]
+    elif sampwidth == 4:
+        data = np.memmap(filename, dtype='<i4', mode='r', offset=offset,
+                         shape=(nframes, nchannels))
+        channels = [(data[:, chn] >> 16).astype(np.int16)
+                    for chn in xrange(nchannels)]
+    else:
+        # 8 bit samples are unsigned
+        data = np.memmap(filename, dtype=np.uint8, mode='r', offset=offset,
+                         shape=(nframes, nchannels))
+        channels = [(data[:, chn].astype(np.int16) - 128) << 8
+                    for chn in xrange(nchannels)]
+
+    return channels, rate
+
+
+def wav_info(filename):
+    """
+    Parses the RIFF header of a WAV file.
+
+    returns: (channels, sample rate, sample width in bytes, offset of the
+    sample data, number of frames), or None if the file isn't an
+    uncompressed PCM WAV file
+    """
+    with open(filename, "rb") as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != "RIFF" or header[8:] != "WAVE":
+            return None
+
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = struct.unpack("<4sI", chunk)
+
+            if chunk_id == "fmt ":
+                data = f.read(size)
+                if len(data) < 16:
+                    return None
+                tag, nchannels, rate, _, block_align, _ = struct.unpack(
+                    "<HHIIHH", data[:16])
+                if tag == WAVE_FORMAT_EXTENSIBLE and len(data) >= 26:
+                    # the sub format GUID starts with the format tag
+                    tag, = struct.unpack("<H", data[24:26])
+                fmt = (tag, nchannels, rate, block_align)
+                f.seek(size % 2, os.SEEK_CUR)
+
+            elif chunk_id == "data":
+                if fmt is None:
+                    return None
+                tag, nchannels, rate, block_align = fmt
+                if (tag != WAVE_FORMAT_PCM or not nchannels or
+                        block_align % nchannels or
+                        block_align // nchannels not in (1, 2, 3, 4)):
+                    return None
+
+                offset = f.tell()
+                # the size is often wrong for files still being written
+                size = min(size, os.fstat(f.fileno()).st_size - offset)
+                return (nchannels, rate, block_align // nchannels, offset,
+                        size // block_align)
+
+            else:
+                f.seek(size + size % 2, os.SEEK_CUR)
 
 
 def path_to_songname(path):
@@ -1,11 +1,14 @@
 import numpy as np
-import matplotlib.mlab as mlab
 import matplotlib.pyplot as plt
+from fractions import gcd
+from scipy import signal
 from scipy.ndimage.filters import maximum_filter
 from scipy.ndimage.morphology import (generate_binary_structure,
                                       iterate_structure, binary_erosion)
 import hashlib
-from operator import itemgetter
+from itertools import izip
+
+from dejavu.spectrogram import LOG_FLOOR, Spectrogram
 
 IDX_FREQ_I = 0
 IDX_TIME_J = 1
@@ -42,6 +45,16 @@ DEFAULT_AMP_MIN = 5
 # fingerprints and faster matching, but can potentially affect accuracy.
 PEAK_NEIGHBORHOOD_SIZE = 20
 
+######################################################################
+# Peak detector used for fingerprinting. "fast" is `find_peaks`, which
+# decomposes the neighborhood into cheap line filters and works on arrays
+# only; "reference" is the original `get_2D_peaks`. Both find the same
+# peaks, which `validate_peaks` checks on real audio.
+PEAK_DETECTOR_FAST = "fast"
+PEAK_DETECTOR_REFERENCE = "reference"
+PEAK_DETECTORS = (PEAK_DETECTOR_FAST, PEAK_DETECTOR_REFERENCE)
+PEAK_DETECTOR = PEAK_DETECTOR_FAST
+
 ######################################################################
 # Thresholds on how close or far fingerprints can be in time in order
 # to be paired as a fingerprint. If your max is too low, higher values of
@@ -61,33 +74,623 @@ PEAK_SORT = True
 # potentially higher collisions and misclassifications when identifying songs.
 FINGERPRINT_REDUCTION = 20
 
+######################################################################
+# Format of the fingerprint hashes. "sha1" is the truncated SHA1 hex
+# digest described above. "packed" stores (freq1, freq2, t_delta) directly
+# in one 64 bit integer, PACKED_FIELD_BITS bits each, which is smaller to
+# store and needs no string formatting or hex conversion. The two formats
+# do not match each other, so a database only ever holds one of them.
+FINGERPRINT_FORMAT_SHA1 = "sha1"
+FINGERPRINT_FORMAT_PACKED = "packed"
+FINGERPRINT_FORMATS = (FINGERPRINT_FORMAT_SHA1, FINGERPRINT_FORMAT_PACKED)
+DEFAULT_FINGERPRINT_FORMAT = FINGERPRINT_FORMAT_SHA1
+PACKED_FIELD_BITS = 16
+
+######################################################################
+# Channels of multichannel audio that are fingerprinted, the "channels"
+# setting of an analysis profile. "all" fingerprints every channel and
+# keeps the union of their hashes, "mono" the average of the channels
+# and "loudest" only the channel with the most energy. The last two do
+# the work of a single channel, and store and query about half the
+# hashes of stereo audio.
+CHANNELS_ALL = "all"
+CHANNELS_MONO = "mono"
+CHANNELS_LOUDEST = "loudest"
+CHANNEL_MODES = (CHANNELS_ALL, CHANNELS_MONO, CHANNELS_LOUDEST)
+
+######################################################################
+# Peak density budget of an analysis profile, which bounds the number of
+# fingerprints per second whatever the loudness of the audio. With
+# "max_peaks" set, a peak is only kept if it is among the "max_peaks"
+# strongest peaks of its band within a window of "peak_window" spectrogram
+# columns centred on it, the spectrum being divided into "peak_bands"
+# equal frequency bands, and "max_pairs" limits the pairs (hashes) made
+# from every anchor peak below `fan_value - 1`. Centred windows keep the
+# same peaks in a clip as in the recording it comes from, away from the
+# clip's edges. DEFAULT_PEAK_WINDOW columns are about a second in both
+# built-in profiles.
+DEFAULT_PEAK_WINDOW = 21
+
+######################################################################
+# Analysis profiles, a database records the one it was fingerprinted
+# with. "full" analyses audio at its own sample rate with
+# DEFAULT_WINDOW_SIZE, looking for peaks at all frequencies. "canonical"
+# resamples audio to 11025 Hz first, with a window of the same duration
+# (so spectrogram columns and frequency bins keep their size), and only
+# looks for peaks below 5 kHz, where most useful peaks are: about a
+# quarter of the work. Custom profiles are dictionaries of the same keys,
+# see `get_profile`.
+PROFILE_FULL = "full"
+PROFILE_CANONICAL = "canonical"
+PROFILES = {
+    PROFILE_FULL: {"rate": None, "window_size": DEFAULT_WINDOW_SIZE,
+                   "min_freq": 0, "max_freq": None,
+                   "channels": CHANNELS_ALL,
+                   "max_peaks": None, "peak_window": DEFAULT_PEAK_WINDOW,
+                   "peak_bands": 1, "max_pairs": None},
+}
+PROFILES[PROFILE_CANONICAL] = dict(PROFILES[PROFILE_FULL], rate=11025,
+                                   window_size=1024, max_freq=5000)
+DEFAULT_PROFILE = PROFILE_FULL
+
+######################################################################
+# Samples `select_channels` converts at once to measure the energy of a
+# channel, so long recordings aren't converted to float all at once.
+ENERGY_BLOCK_SIZE = 1 << 20
+
+######################################################################
+# Number of spectrogram columns `fingerprint_stream` processes at once.
+# Memory use is bounded by this rather than by the length of the track;
+# 1024 columns are roughly 48 seconds at the default settings.
+DEFAULT_STREAM_BLOCK_SIZE = 1024
+
+######################################################################
+# Number of new spectrogram columns `StreamFingerprinter` waits for
+# before looking for their peaks. The peak filter also runs over
+# PEAK_NEIGHBORHOOD_SIZE columns of context on both sides, so searching
+# every few columns would cost many times the one-shot detection; 32
+# columns, about 1.5 seconds, keep it near twice that.
+DEFAULT_FEED_BLOCK_SIZE = 32
+
 
 def fingerprint(channel_samples, Fs=DEFAULT_FS,
                 wsize=DEFAULT_WINDOW_SIZE,
                 wratio=DEFAULT_OVERLAP_RATIO,
                 fan_value=DEFAULT_FAN_VALUE,
-                amp_min=DEFAULT_AMP_MIN):
+                amp_min=DEFAULT_AMP_MIN,
+                hash_format=DEFAULT_FINGERPRINT_FORMAT,
+                profile=None):
     """
     FFT the channel, log transform output, find local maxima, then return
     locally sensitive hashes.
-    """
-    # FFT the signal and extract frequency components
-    arr2D = mlab.specgram(
-        channel_samples,
-        NFFT=wsize,
-        Fs=Fs,
-        window=mlab.window_hanning,
-        noverlap=int(wsize * wratio))[0]
 
-    # apply log transform since specgram() returns linear array
-    arr2D = 10 * np.log10(arr2D)
-    arr2D[arr2D == -np.inf] = 0  # replace infs with zeros
+    With an analysis `profile` (see `get_profile`) the channel is
+    resampled and analysed as it says, overriding `wsize`, and its peak
+    density budget applies.
+    """
+    rate, wsize, band = analysis(profile, Fs, wsize)
+    budget = _peak_budget(profile, rate, wsize)
+    channel_samples = resample(channel_samples, Fs, rate)
+    arr2D = get_spectrogram(channel_samples, Fs=rate, wsize=wsize,
+                            wratio=wratio)
 
     # find local maxima
-    local_maxima = get_2D_peaks(arr2D, plot=False, amp_min=amp_min)
+    local_maxima = _detect_peaks(arr2D, amp_min, band=band)
+    if budget is not None:
+        local_maxima = _limit_peaks(local_maxima, arr2D, budget)
 
     # return hashes
-    return generate_hashes(local_maxima, fan_value=fan_value)
+    return generate_hashes(local_maxima,
+                           fan_value=get_fan_value(profile, fan_value),
+                           hash_format=hash_format)
+
+
+def fingerprint_stream(channel_samples, Fs=DEFAULT_FS,
+                       wsize=DEFAULT_WINDOW_SIZE,
+                       wratio=DEFAULT_OVERLAP_RATIO,
+                       fan_value=DEFAULT_FAN_VALUE,
+                       amp_min=DEFAULT_AMP_MIN,
+                       hash_format=DEFAULT_FINGERPRINT_FORMAT,
+                       block_size=DEFAULT_STREAM_BLOCK_SIZE,
+                       profile=None):
+    """
+    Same hashes, in the same order, as `fingerprint`, but computed over
+    blocks of `block_size` spectrogram columns and yielded as each block
+    is done, so memory stays bounded for arbitrarily long recordings.
+
+    Peaks come from `_stream_peaks`, identical to those of the one-shot
+    spectrogram. Peaks whose pairs may still reach into the next block
+    (less than `fan_value` peaks and MAX_HASH_TIME_DELTA columns away from
+    its start) are carried over until they are complete.
+    """
+    rate, wsize, band = analysis(profile, Fs, wsize)
+    budget = _peak_budget(profile, rate, wsize)
+    fan_value = get_fan_value(profile, fan_value)
+    channel_samples = resample(channel_samples, Fs, rate)
+    noverlap = int(wsize * wratio)
+    ncols = (len(channel_samples) - noverlap) // (wsize - noverlap)
+
+    # without PEAK_SORT pairs follow detection order, which is per block
+    if ncols <= block_size or not PEAK_SORT:
+        for h in fingerprint(channel_samples, Fs=rate, wsize=wsize,
+                             wratio=wratio, fan_value=fan_value,
+                             amp_min=amp_min, hash_format=hash_format,
+                             profile=profile):
+            yield h
+        return
+
+    pending = np.empty((0, 2), dtype=np.int64)
+    for peaks, end in _stream_peaks(channel_samples, rate, wsize, wratio,
+                                    amp_min, block_size, band=band,
+                                    budget=budget):
+        pending = np.concatenate((pending, peaks))
+        hashes, pending = _complete_hashes(
+            pending, end if end < ncols else None, fan_value, hash_format)
+        for h in hashes:
+            yield h
+
+
+def get_peaks(channel_samples, Fs=DEFAULT_FS,
+              wsize=DEFAULT_WINDOW_SIZE,
+              wratio=DEFAULT_OVERLAP_RATIO,
+              amp_min=DEFAULT_AMP_MIN,
+              block_size=DEFAULT_STREAM_BLOCK_SIZE,
+              start=0, end=None, detector=None, profile=None):
+    """
+    Returns the spectral peaks of the channel as an int64 array of
+    (freq, time) rows, computed block by block like `fingerprint_stream`
+    so the full spectrogram is never held in memory.
+
+    With `start` and `end` only the peaks of spectrogram columns
+    [start, end) are returned, still the same as in the full spectrogram.
+    `detector` is one of PEAK_DETECTORS, PEAK_DETECTOR by default.
+    Columns are those of the analysis `profile`, if any.
+    """
+    rate, wsize, band = analysis(profile, Fs, wsize)
+    budget = _peak_budget(profile, rate, wsize)
+    channel_samples = resample(channel_samples, Fs, rate)
+    blocks = [peaks for peaks, _ in _stream_peaks(channel_samples, rate,
+                                                  wsize, wratio, amp_min,
+                                                  block_size, start, end,
+                                                  detector, band, budget)]
+    return np.concatenate(blocks or [np.empty((0, 2), dtype=np.int64)])
+
+
+def validate_peaks(channel_samples, Fs=DEFAULT_FS,
+                   wsize=DEFAULT_WINDOW_SIZE,
+                   wratio=DEFAULT_OVERLAP_RATIO,
+                   amp_min=DEFAULT_AMP_MIN):
+    """
+    Finds the peaks of the channel with both detectors and reports how
+    far they agree.
+
+    returns: a dictionary with the number of peaks of each detector, by
+    name, the number both found (`common`), the ratio of that to all
+    peaks found (`agreement`) and whether both returned the same peaks
+    in the same order (`identical`)
+    """
+    peaks = dict((detector, get_peaks(channel_samples, Fs=Fs, wsize=wsize,
+                                      wratio=wratio, amp_min=amp_min,
+                                      detector=detector))
+                 for detector in PEAK_DETECTORS)
+    reference = set(map(tuple, peaks[PEAK_DETECTOR_REFERENCE].tolist()))
+    fast = set(map(tuple, peaks[PEAK_DETECTOR_FAST].tolist()))
+
+    report = dict((detector, len(found))
+                  for detector, found in peaks.iteritems())
+    report["common"] = len(reference & fast)
+    report["agreement"] = (float(report["common"]) / len(reference | fast)
+                           if reference | fast else 1.0)
+    report["identical"] = np.array_equal(peaks[PEAK_DETECTOR_REFERENCE],
+                                         peaks[PEAK_DETECTOR_FAST])
+    return report
+
+
+def _stream_peaks(channel_samples, Fs, wsize, wratio, amp_min, block_size,
+                  first=0, last=None, detector=None, band=None, budget=None):
+    """
+    Yields (peaks, end) for every block of `block_size` spectrogram
+    columns between `first` and `last`, `peaks` being an int64 array of
+    the (freq, time) peaks found in columns before `end` that weren't
+    yielded yet.
+
+    Every block is analysed together with PEAK_NEIGHBORHOOD_SIZE columns
+    of context on both sides, which makes its peaks identical to those
+    of the one-shot spectrogram. With a peak density `budget`, the peaks
+    of half a budget window on both sides are found too, as the peaks of
+    the block compete with them, so the same peaks are kept as well.
+    """
+    noverlap = int(wsize * wratio)
+    step = wsize - noverlap
+    ncols = (len(channel_samples) - noverlap) // step
+    last = ncols if last is None else min(last, ncols)
+
+    if first <= 0 and last == ncols and ncols <= block_size:
+        arr2D = get_spectrogram(channel_samples, Fs=Fs, wsize=wsize,
+                                wratio=wratio)
+        peaks = _detect_peaks(arr2D, amp_min, detector, band)
+        if budget is not None:
+            peaks = _limit_peaks(peaks, arr2D, budget)
+        yield peaks, ncols
+        return
+
+    reach = budget[1] // 2 if budget is not None else 0
+    # blocks are done one at a time, so they can share buffers
+    spectrogram = Spectrogram(Fs, wsize, wratio, reuse=True)
+    for start in xrange(max(first, 0), last, block_size):
+        end = min(start + block_size, last)
+        analysed_start = max(start - reach, 0)
+        analysed_end = min(end + reach, ncols)
+        context_start = max(analysed_start - PEAK_NEIGHBORHOOD_SIZE, 0)
+        context_end = min(analysed_end + PEAK_NEIGHBORHOOD_SIZE, ncols)
+
+        block = channel_samples[context_start * step:
+                                (context_end - 1) * step + wsize]
+        arr2D = spectrogram(block)
+        peaks = _detect_peaks(arr2D, amp_min, detector, band)
+        if budget is not None:
+            times = peaks[:, IDX_TIME_J] + context_start
+            peaks = _limit_peaks(
+                peaks[(times >= analysed_start) & (times < analysed_end)],
+                arr2D, budget)
+        peaks[:, IDX_TIME_J] += context_start
+        times = peaks[:, IDX_TIME_J]
+        yield peaks[(times >= start) & (times < end)], end
+
+
+class StreamFingerprinter(object):
+    """
+    Fingerprints one channel of audio that arrives in chunks, e.g. from a
+    pipe or a socket.
+
+    Every `feed` only computes the spectrogram columns its samples
+    complete and, once `block_size` more columns have
+    PEAK_NEIGHBORHOOD_SIZE columns on both sides, looks for their peaks.
+    It returns the hashes whose pairs can't change any more. Together
+    with `flush` at the end of the stream, these are the hashes
+    `fingerprint` computes for the whole recording, offsets counted from
+    the start of the stream. Only the samples of the next column and the
+    spectrogram columns and peaks still needed as context are kept.
+
+    With an analysis `profile` the samples are resampled as they arrive,
+    by a `Resampler`, and `rate` and `wsize` are those of the profile.
+    With its peak density budget, peaks are only final half a budget
+    window later, once the peaks they compete with are known.
+    """
+
+    def __init__(self, Fs=DEFAULT_FS,
+                 wsize=DEFAULT_WINDOW_SIZE,
+                 wratio=DEFAULT_OVERLAP_RATIO,
+                 fan_value=DEFAULT_FAN_VALUE,
+                 amp_min=DEFAULT_AMP_MIN,
+                 hash_format=DEFAULT_FINGERPRINT_FORMAT,
+                 profile=None,
+                 block_size=DEFAULT_FEED_BLOCK_SIZE):
+        super(StreamFingerprinter, self).__init__()
+        self.Fs = Fs
+        self.rate, self.wsize, self._band = analysis(profile, Fs, wsize)
+        self.wratio = wratio
+        self.fan_value = get_fan_value(profile, fan_value)
+        self.amp_min = amp_min
+        self.hash_format = hash_format
+        self.profile = profile
+        self.block_size = block_size
+
+        self._resampler = (Resampler(Fs, self.rate) if self.rate != Fs
+                           else None)
+        self._budget = _peak_budget(profile, self.rate, self.wsize)
+        # peaks a kept peak competes with are this many columns away
+        self._reach = self._budget[1] // 2 if self._budget is not None else 0
+        self._spectrogram = Spectrogram(self.rate, self.wsize, wratio,
+                                        reuse=True)
+        self._noverlap = int(self.wsize * wratio)
+        self._step = self.wsize - self._noverlap
+        # samples from the first column not computed yet
+        self._samples = np.empty(0, dtype=np.int16)
+        # spectrogram columns [_origin, columns) still needed as context
+        self._arr2D = np.empty((self.wsize // 2 + 1, 0), dtype=np.float32)
+        self._origin = 0
+        self._columns = 0
+        # peaks found in the columns before `_detected`, not all final
+        self._peaks = np.empty((0, 2), dtype=np.int64)
+        self._detected = 0
+        # columns whose final peaks have been found
+        self._done = 0
+        self._pending = np.empty((0, 2), dtype=np.int64)
+
+    @property
+    def columns(self):
+        """
+        Number of spectrogram columns the samples fed so far make up.
+        """
+        return self._columns
+
+    def feed(self, samples):
+        """
+        Adds samples to the stream.
+
+        returns: list of new (hash, offset) pairs
+        """
+        if self._resampler is not None:
+            samples = self._resampler.feed(samples)
+        self._samples = np.concatenate((self._samples, samples))
+
+        ncols = (len(self._samples) - self._noverlap) // self._step
+        if ncols > 0:
+            arr2D = self._spectrogram(
+                self._samples[:(ncols - 1) * self._step + self.wsize])
+            self._arr2D = np.concatenate((self._arr2D, arr2D), axis=1)
+            self._samples = self._samples[ncols * self._step:]
+            self._columns += ncols
+        return self._advance(False)
+
+    def flush(self):
+        """
+        Ends the stream.
+
+        returns: list of the remaining (hash, offset) pairs
+        """
+        return self._advance(True)
+
+    def _advance(self, final):
+        # peaks are found once PEAK_NEIGHBORHOOD_SIZE columns follow them,
+        # a block at a time
+        detect = (self._columns if final else
+                  self._columns - PEAK_NEIGHBORHOOD_SIZE)
+        if detect >= self._detected + (1 if final else self.block_size):
+            first = max(self._detected - PEAK_NEIGHBORHOOD_SIZE, self._origin)
+            peaks = _detect_peaks(self._arr2D[:, first - self._origin:],
+                                  self.amp_min, band=self._band)
+            peaks[:, IDX_TIME_J] += first
+            times = peaks[:, IDX_TIME_J]
+            self._peaks = np.concatenate(
+                (self._peaks,
+                 peaks[(times >= self._detected) & (times < detect)]))
+            self._detected = detect
+
+        # and final once the peaks they compete with are found
+        end = self._detected if final else self._detected - self._reach
+        if end > self._done:
+            peaks = self._peaks
+            if self._budget is not None:
+                peaks = peaks.copy()
+                peaks[:, IDX_TIME_J] -= self._origin
+                peaks = _limit_peaks(peaks, self._arr2D, self._budget)
+                peaks[:, IDX_TIME_J] += self._origin
+            times = peaks[:, IDX_TIME_J]
+            self._pending = np.concatenate(
+                (self._pending, peaks[(times >= self._done) & (times < end)]))
+            self._done = end
+
+            # keep what the next columns need as context
+            origin = max(min(self._detected - PEAK_NEIGHBORHOOD_SIZE,
+                             self._done - self._reach), self._origin)
+            self._arr2D = self._arr2D[:, origin - self._origin:]
+            self._origin = origin
+            self._peaks = self._peaks[
+                self._peaks[:, IDX_TIME_J] >= self._done - self._reach]
+
+        hashes, self._pending = _complete_hashes(
+            self._pending, None if final else self._done, self.fan_value,
+            self.hash_format)
+        return hashes
+
+
+def get_profile(profile=None):
+    """
+    Returns the settings of an analysis profile: one of PROFILES by name,
+    DEFAULT_PROFILE for None, or a dictionary of settings completed with
+    those of PROFILE_FULL. A custom `rate` without a `window_size` gets a
+    window of the same duration as DEFAULT_WINDOW_SIZE at DEFAULT_FS.
+
+    returns: a dictionary of `rate` (None keeps the rate of the audio),
+    `window_size`, the `min_freq` and `max_freq` in Hz peaks are looked
+    for between (None for no limit), `channels`, one of CHANNEL_MODES,
+    and the peak density budget `max_peaks`, `peak_window`, `peak_bands`
+    and `max_pairs` (None for no limit)
+    """
+    if profile is None:
+        profile = DEFAULT_PROFILE
+    if isinstance(profile, basestring):
+        if profile not in PROFILES:
+            raise ValueError("Unsupported analysis profile: %r" % profile)
+        return dict(PROFILES[profile])
+
+    settings = dict(PROFILES[PROFILE_FULL])
+    if profile.get("rate") is not None and "window_size" not in profile:
+        settings["window_size"] = int(round(
+            DEFAULT_WINDOW_SIZE * float(profile["rate"]) / DEFAULT_FS))
+    settings.update(profile)
+
+    unknown = set(settings) - set(PROFILES[PROFILE_FULL])
+    if unknown:
+        raise ValueError("Unsupported analysis profile settings: %s" %
+                         ", ".join(sorted(unknown)))
+    if (settings["max_freq"] is not None and
+            settings["max_freq"] <= settings["min_freq"]):
+        raise ValueError("Empty analysis band: %r to %r Hz" %
+                         (settings["min_freq"], settings["max_freq"]))
+    if settings["channels"] not in CHANNEL_MODES:
+        raise ValueError("Unsupported channel mode: %r" %
+                         settings["channels"])
+    for name in ("max_peaks", "peak_window", "peak_bands", "max_pairs"):
+        value = settings[name]
+        if (value is not None or name in ("peak_window", "peak_bands")) and (
+                not isinstance(value, (int, long)) or value < 1):
+            raise ValueError("Analysis profile setting %s must be a "
+                             "positive integer: %r" % (name, value))
+    return settings
+
+
+def get_fan_value(profile=None, fan_value=DEFAULT_FAN_VALUE):
+    """
+    Returns `fan_value` lowered so that no peak is paired with more than
+    `max_pairs` others, as the profile says.
+    """
+    if profile is None:
+        return fan_value
+    max_pairs = get_profile(profile)["max_pairs"]
+    if max_pairs is None:
+        return fan_value
+    return min(fan_value, max_pairs + 1)
+
+
+def select_channels(channels, profile=None):
+    """
+    Returns the list of channels to fingerprint according to the
+    `channels` setting of the profile, all of them without a profile.
+    """
+    if profile is None or len(channels) <= 1:
+        return list(channels)
+
+    mode = get_profile(profile)["channels"]
+    if mode == CHANNELS_MONO:
+        return [downmix(channels)]
+    elif mode == CHANNELS_LOUDEST:
+        energies = [_energy(channel) for channel in channels]
+        return [channels[energies.index(max(energies))]]
+    return list(channels)
+
+
+def downmix(channels):
+    """
+    Returns the float32 average of equally long channels.
+    """
+    mixed = np.array(channels[0], dtype=np.float32)
+    for channel in channels[1:]:
+        mixed += channel
+    mixed /= len(channels)
+    return mixed
+
+
+def _energy(channel):
+    total = 0.0
+    for i in xrange(0, len(channel), ENERGY_BLOCK_SIZE):
+        block = np.asarray(channel[i:i + ENERGY_BLOCK_SIZE],
+                           dtype=np.float64)
+        total += np.dot(block, block)
+    return total
+
+
+def analysis(profile, Fs, wsize=DEFAULT_WINDOW_SIZE):
+    """
+    Returns how audio sampled at `Fs` is analysed with a profile, by name
+    or settings (see `get_profile`), or None to keep `Fs` and `wsize`.
+
+    returns: (rate, window size, band), `band` being the [first, last)
+    spectrogram rows peaks are looked for in, or None for all of them
+    """
+    if profile is None:
+        return Fs, wsize, None
+
+    profile = get_profile(profile)
+    rate = profile["rate"] or Fs
+    wsize = profile["window_size"]
+    nfreqs = wsize // 2 + 1
+    first = int(np.ceil(profile["min_freq"] * wsize / float(rate)))
+    last = nfreqs
+    if profile["max_freq"] is not None:
+        last = min(int(profile["max_freq"] * wsize / float(rate)) + 1,
+                   nfreqs)
+
+    band = (first, last) if (first, last) != (0, nfreqs) else None
+    return rate, wsize, band
+
+
+def _peak_budget(profile, Fs, wsize=DEFAULT_WINDOW_SIZE):
+    """
+    Returns the peak density budget of a profile for audio analysed at
+    `Fs` with `wsize`: (max_peaks, peak_window, peak_bands, rows), `rows`
+    being the [first, last) spectrogram rows the bands divide, or None
+    without a budget.
+    """
+    if profile is None:
+        return None
+    profile = get_profile(profile)
+    if profile["max_peaks"] is None:
+        return None
+
+    _, _, band = analysis(profile, Fs, wsize)
+    return (profile["max_peaks"], profile["peak_window"],
+            profile["peak_bands"], band or (0, wsize // 2 + 1))
+
+
+def resample(channel_samples, Fs, rate):
+    """
+    Returns the channel resampled from `Fs` to `rate` by a `Resampler`,
+    or unchanged if the rates are the same.
+    """
+    if rate == Fs:
+        return channel_samples
+    return Resampler(Fs, rate).feed(channel_samples)
+
+
+class Resampler(object):
+    """
+    Resamples audio from `Fs` to `rate` with a polyphase low-pass filter,
+    designed like `scipy.signal.resample_poly` does.
+
+    Audio can be fed in chunks of any size: every `feed` returns the
+    output samples its input completes, which together are exactly those
+    of resampling all the audio at once. Only the input the filter still
+    needs is kept.
+    """
+
+    def __init__(self, Fs, rate):
+        super(Resampler, self).__init__()
+        divisor = gcd(int(Fs), int(rate))
+        self.up = int(rate) // divisor
+        self.down = int(Fs) // divisor
+
+        max_rate = max(self.up, self.down)
+        half_len = 10 * max_rate
+        self.taps = signal.firwin(2 * half_len + 1, 1.0 / max_rate,
+                                  window=('kaiser', 5.0)) * self.up
+
+        self._samples = np.empty(0, dtype=np.float32)
+        # input index of the first kept sample, a multiple of `down` so
+        # output samples stay on the same grid
+        self._origin = 0
+        # output samples returned so far
+        self._done = 0
+
+    def feed(self, samples):
+        """
+        Adds input samples.
+
+        returns: float32 array of the new output samples
+        """
+        self._samples = np.concatenate((self._samples, samples))
+        ninput = self._origin + len(self._samples)
+        # output m is complete once input (m * down) / up arrived
+        end = ((ninput - 1) * self.up) // self.down + 1 if ninput else 0
+        if end <= self._done:
+            return np.empty(0, dtype=np.float32)
+
+        output = signal.upfirdn(self.taps, self._samples, self.up, self.down)
+        first = self._origin * self.up // self.down
+        output = output[self._done - first:end - first].astype(np.float32)
+        self._done = end
+
+        # later output samples only need input from here on
+        needed = max((self._done * self.down - len(self.taps) + 1) //
+                     self.up, 0)
+        needed -= needed % self.down
+        if needed > self._origin:
+            self._samples = self._samples[needed - self._origin:]
+            self._origin = needed
+        return output
+
+
+def get_spectrogram(channel_samples, Fs=DEFAULT_FS,
+                    wsize=DEFAULT_WINDOW_SIZE,
+                    wratio=DEFAULT_OVERLAP_RATIO):
+    """
+    Returns the log-scaled spectrogram of the channel, frequencies on the
+    first axis and time on the second, as a float32 array (see
+    `dejavu.spectrogram.Spectrogram`).
+    """
+    return Spectrogram(Fs, wsize, wratio)(channel_samples)
 
 
 def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
@@ -97,7 +700,7 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
 
     # find local maxima using our filter shape
     local_max = maximum_filter(arr2D, footprint=neighborhood) == arr2D
-    background = (arr2D == 0)
+    background = (arr2D == LOG_FLOOR)
     eroded_background = binary_erosion(background, structure=neighborhood,
                                        border_value=1)
 
@@ -131,26 +734,287 @@ def get_2D_peaks(arr2D, plot=False, amp_min=DEFAULT_AMP_MIN):
     return zip(frequency_idx, time_idx)
 
 
-def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE):
+def find_peaks(arr2D, amp_min=DEFAULT_AMP_MIN):
+    """
+    Same peaks, in the same order, as `get_2D_peaks`, but found without
+    footprint filters or Python lists.
+
+    The diamond neighborhood of PEAK_NEIGHBORHOOD_SIZE is the maximum
+    over two diagonal line segments and a cross or two, each line
+    filtered in a logarithmic number of array passes, and the erosion of
+    the background is only needed when `amp_min` lets silent cells
+    (LOG_FLOOR) through.
+
+    returns: int64 array of (freq, time) rows
+    """
+    detected = arr2D > amp_min
+    if not detected.any():
+        return np.empty((0, 2), dtype=np.int64)
+
+    # `iterate_structure` never makes less than the cross
+    radius = max(PEAK_NEIGHBORHOOD_SIZE, 1)
+    detected &= _diamond_max(arr2D, radius) == arr2D
+    if amp_min < LOG_FLOOR:
+        # silent cells surrounded by silence only are background, not peaks
+        audible = (arr2D != LOG_FLOOR).astype(np.float32)
+        detected &= _diamond_max(audible, radius) > 0
+
+    return np.transpose(np.nonzero(detected)).astype(np.int64)
+
+
+def _diamond_max(arr2D, radius):
+    """
+    Maximum of every cell's neighborhood of cells at most `radius` steps
+    away (the footprint of `iterate_structure`), borders ignored like the
+    reflecting `maximum_filter` of `get_2D_peaks` does.
+
+    The diamond of radius 2a + 1 is the sum of diagonal segments of
+    2a + 1 cells in both directions and a cross; the array is padded
+    with -inf so intermediate results near the borders stay exact.
+    """
+    cross = generate_binary_structure(2, 1)
+    half = (radius - 1) // 2
+    if arr2D.dtype.kind != 'f':
+        arr2D = arr2D.astype(np.float64)
+    m = np.pad(arr2D, radius, mode='constant', constant_values=-np.inf)
+
+    if half > 0:
+        m = _line_max(m, half, 1)
+        m = _line_max(m, half, -1)
+    for _ in xrange(radius - 2 * half):
+        m = maximum_filter(m, footprint=cross)
+
+    return m[radius:-radius, radius:-radius]
+
+
+def _line_max(m, half, direction):
+    """
+    Maximum over diagonal segments of 2 * `half` + 1 cells centred on
+    every cell, along (1, `direction`).
+    """
+    out = m.copy()
+    span = 1
+    while span < 2 * half + 1:
+        # windows of `span` cells grow to `span + step` cells
+        step = min(span, 2 * half + 1 - span)
+        if direction > 0:
+            head, tail = out[:-step, :-step], out[step:, step:]
+        else:
+            head, tail = out[:-step, step:], out[step:, :-step]
+        head[...] = np.maximum(head, tail)
+        span += step
+
+    centred = np.empty_like(out)
+    centred.fill(-np.inf)
+    if direction > 0:
+        centred[half:, half:] = out[:-half, :-half]
+    else:
+        centred[half:, :-half] = out[:-half, half:]
+    return centred
+
+
+def _detect_peaks(arr2D, amp_min, detector=None, band=None):
+    """
+    Finds peaks with one of PEAK_DETECTORS, PEAK_DETECTOR by default,
+    only in the [first, last) rows of `band` if given.
+
+    returns: int64 array of (freq, time) rows
+    """
+    if band is not None:
+        arr2D = arr2D[band[0]:band[1]]
+
+    detector = detector or PEAK_DETECTOR
+    if detector == PEAK_DETECTOR_FAST:
+        peaks = find_peaks(arr2D, amp_min=amp_min)
+    elif detector != PEAK_DETECTOR_REFERENCE:
+        raise ValueError("Unsupported peak detector: %r" % detector)
+    else:
+        peaks = np.asarray(get_2D_peaks(arr2D, plot=False, amp_min=amp_min),
+                           dtype=np.int64).reshape(-1, 2)
+
+    if band is not None:
+        peaks[:, IDX_FREQ_I] += band[0]
+    return peaks
+
+
+def _limit_peaks(peaks, arr2D, budget):
+    """
+    Keeps the peaks that are among the `max_peaks` strongest of their band
+    within `peak_window // 2` columns on either side, for a peak density
+    `budget` (see `_peak_budget`), in their original order. Equally strong
+    peaks rank earliest, then lowest, first.
+
+    `peaks` are (freq, time) cells of `arr2D`. Only the peaks of columns
+    with all of their window given are kept as in the whole recording.
+    """
+    max_peaks, window, bands, (first, last) = budget
+    if not len(peaks):
+        return peaks
+
+    freqs = peaks[:, IDX_FREQ_I]
+    times = peaks[:, IDX_TIME_J]
+    # 0 for the strongest peak
+    strength = np.empty(len(peaks), dtype=np.int64)
+    strength[np.lexsort((freqs, times, -arr2D[freqs, times]))] = \
+        np.arange(len(peaks))
+
+    # by band and time, the peaks of every window follow each other
+    groups = (freqs - first) * bands // (last - first)
+    order = np.lexsort((times, groups))
+    groups, times, strength = groups[order], times[order], strength[order]
+
+    # compare every peak with the one k places later, until none is near
+    stronger = np.zeros(len(peaks), dtype=np.int64)
+    for k in xrange(1, len(peaks)):
+        near = ((groups[k:] == groups[:-k]) &
+                (times[k:] - times[:-k] <= window // 2))
+        if not near.any():
+            break
+        later_wins = strength[k:] < strength[:-k]
+        stronger[:-k] += near & later_wins
+        stronger[k:] += near & ~later_wins
+
+    keep = np.zeros(len(peaks), dtype=bool)
+    keep[order[stronger < max_peaks]] = True
+    return peaks[keep]
+
+
+def pair_peaks(peaks, fan_value=DEFAULT_FAN_VALUE):
+    """
+    Builds every (anchor, target) peak pairing at once.
+
+    Each peak is paired with the following `fan_value - 1` peaks, the same
+    pairs the original nested loop in `generate_hashes` visited, and pairs
+    outside [MIN_HASH_TIME_DELTA, MAX_HASH_TIME_DELTA] are dropped. Pairs are
+    returned in anchor-major order, exactly as the loop emitted them.
+
+    returns: (freq1, freq2, t_delta, t1) integer arrays
+    """
+    peaks, anchor, target = _pair_indices(peaks, fan_value)
+    return _pair_fields(peaks, anchor, target)
+
+
+def _pair_indices(peaks, fan_value):
+    """
+    Returns the (sorted) peaks array and the anchor and target indices
+    into it of every pair, in anchor-major order.
+    """
+    peaks = np.asarray(peaks, dtype=np.int64).reshape(-1, 2)
+    if PEAK_SORT:
+        # mergesort is stable, matching list.sort on the time index
+        peaks = peaks[np.argsort(peaks[:, IDX_TIME_J], kind='mergesort')]
+
+    times = peaks[:, IDX_TIME_J]
+    npeaks = len(peaks)
+
+    # (npeaks, fan_value - 1) grid of anchor/target indices
+    steps = np.arange(1, max(fan_value, 1))
+    anchor = np.repeat(np.arange(npeaks)[:, np.newaxis], len(steps), axis=1)
+    target = anchor + steps
+    valid = target < npeaks
+    target[~valid] = 0
+
+    t_delta = times[target] - times[anchor]
+    valid &= (t_delta >= MIN_HASH_TIME_DELTA) & (t_delta <= MAX_HASH_TIME_DELTA)
+
+    # boolean indexing flattens row-major, keeping anchor-major order
+    return peaks, anchor[valid], target[valid]
+
+
+def _pair_fields(peaks, anchor, target):
+    freqs = peaks[:, IDX_FREQ_I]
+    times = peaks[:, IDX_TIME_J]
+    return (freqs[anchor], freqs[target], times[target] - times[anchor],
+            times[anchor])
+
+
+def _complete_hashes(peaks, done, fan_value, hash_format):
+    """
+    Hashes the anchors among `peaks` whose pairs can't change any more
+    once peaks at or after time `done` are found; `done` is None at the
+    end of the signal.
+
+    returns: (hashes, remaining peaks to carry over)
+    """
+    peaks, anchor, target = _pair_indices(peaks, fan_value)
+
+    ncomplete = len(peaks)
+    if done is not None:
+        # an anchor is unfinished if it lacks `fan_value - 1` successors
+        # and a later peak could still be within MAX_HASH_TIME_DELTA
+        unfinished = ((np.arange(len(peaks)) + fan_value - 1 >= len(peaks)) &
+                      (peaks[:, IDX_TIME_J] >= done - MAX_HASH_TIME_DELTA))
+        if unfinished.any():
+            ncomplete = int(np.argmax(unfinished))
+
+    keep = anchor < ncomplete
+    freq1, freq2, t_delta, t1 = _pair_fields(peaks, anchor[keep],
+                                             target[keep])
+    return (_hash_pairs(freq1, freq2, t_delta, t1, hash_format),
+            peaks[ncomplete:])
+
+
+def pack_hashes(freq1, freq2, t_delta):
+    """
+    Packs (freq1, freq2, t_delta) arrays into "packed" format hashes.
+
+    returns: int64 array, freq1 in the highest field
+    """
+    limit = 1 << PACKED_FIELD_BITS
+    freq1 = np.asarray(freq1, dtype=np.int64)
+    freq2 = np.asarray(freq2, dtype=np.int64)
+    t_delta = np.asarray(t_delta, dtype=np.int64)
+    for field in (freq1, freq2, t_delta):
+        if field.size and (field.min() < 0 or field.max() >= limit):
+            raise ValueError("Value does not fit in %d bits of a packed "
+                             "fingerprint." % PACKED_FIELD_BITS)
+
+    return ((freq1 << (2 * PACKED_FIELD_BITS)) |
+            (freq2 << PACKED_FIELD_BITS) |
+            t_delta)
+
+
+def unpack_hashes(hashes):
+    """
+    Inverse of `pack_hashes`.
+
+    returns: (freq1, freq2, t_delta) int64 arrays
+    """
+    hashes = np.asarray(hashes, dtype=np.int64)
+    mask = (1 << PACKED_FIELD_BITS) - 1
+    return ((hashes >> (2 * PACKED_FIELD_BITS)) & mask,
+            (hashes >> PACKED_FIELD_BITS) & mask,
+            hashes & mask)
+
+
+def generate_hashes(peaks, fan_value=DEFAULT_FAN_VALUE,
+                    hash_format=DEFAULT_FINGERPRINT_FORMAT):
     """
     Hash list structure:
        sha1_hash[0:20]    time_offset
     [(e05b341a9b77a51fd26, 32), ... ]
+
+    or, with the "packed" hash format:
+       packed_hash        time_offset
+    [(4393773826061, 32), ... ]
+
+    Peak pairs are built in bulk by `pair_peaks`; the SHA1 hashes are
+    bit-identical to the historical per-pair SHA1 prefixes, so fingerprints
+    already stored in a database keep matching.
     """
-    if PEAK_SORT:
-        peaks.sort(key=itemgetter(1))
-
-    for i in range(len(peaks)):
-        for j in range(1, fan_value):
-            if (i + j) < len(peaks):
-
-                freq1 = peaks[i][IDX_FREQ_I]
-                freq2 = peaks[i + j][IDX_FREQ_I]
-                t1 = peaks[i][IDX_TIME_J]
-                t2 = peaks[i + j][IDX_TIME_J]
-                t_delta = t2 - t1
-
-                if MIN_HASH_TIME_DELTA <= t_delta <= MAX_HASH_TIME_DELTA:
-                    h = hashlib.sha1(
-                        "%s|%s|%s" % (str(freq1), str(freq2), str(t_delta)))
-                    yield (h.hexdigest()[0:FINGERPRINT_REDUCTION], t1)
+    freq1, freq2, t_delta, t1 = pair_peaks(peaks, fan_value=fan_value)
+    return _hash_pairs(freq1, freq2, t_delta, t1, hash_format)
+
+
+def _hash_pairs(freq1, freq2, t_delta, t1, hash_format):
+    if hash_format == FINGERPRINT_FORMAT_PACKED:
+        return zip(pack_hashes(freq1, freq2, t_delta).tolist(), t1.tolist())
+    elif hash_format != FINGERPRINT_FORMAT_SHA1:
+        raise ValueError("Unsupported fingerprint format: %r" % hash_format)
+
+    sha1 = hashlib.sha1
+    return [(sha1("%d|%d|%d" % triple).hexdigest()[0:FINGERPRINT_REDUCTION],
+             offset)
+            for triple, offset in izip(izip(freq1.tolist(), freq2.tolist(),
+                                            t_delta.tolist()),
+                                       t1.tolist())]
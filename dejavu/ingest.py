@@ -0,0 +1,340 @@
+from collections import defaultdict
+import multiprocessing
+import Queue
+import sys
+import threading
+import traceback
+
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
+
+######################################################################
+# Number of fingerprints a writer collects, over as many songs as it
+# takes, before storing them all in one `Database.insert_songs` batch.
+DEFAULT_BATCH_SIZE = 200000
+
+######################################################################
+# Number of threads hashing files to check whether they are already in the
+# database. Hashing is mostly waiting on disk (or the network, for files on
+# a NAS), so threads are enough to overlap it.
+DEFAULT_SCANNERS = 4
+
+######################################################################
+# Seconds a writer waits for more songs before storing a partial batch.
+DEFAULT_BATCH_TIMEOUT = 1.0
+
+######################################################################
+# Seconds `IngestPipeline.wait` waits for a result before checking that
+# the decoder and fingerprinter processes are still alive. One that died
+# (killed for memory, crashed in a decoder library) never reports the
+# file it was working on.
+WORKER_CHECK_INTERVAL = 1.0
+
+# results reported back to `IngestPipeline.wait`
+RESULT_DONE = "done"
+RESULT_SKIPPED = "skipped"
+RESULT_FAILED = "failed"
+
+
+class IngestPipeline(object):
+    """
+    Long-lived fingerprinting pipeline for adding files to a database.
+
+    Files pass through four stages connected by queues:
+
+    1. scanner threads hash each file once, optionally through a
+       `decoder.HashCache`, and drop files already in the database,
+    2. decoder processes read the audio (pydub/ffmpeg); PCM WAV files
+       skip this stage and are memory-mapped by the fingerprinters,
+    3. fingerprinter processes turn the channels into hashes,
+    4. writer threads collect the hashes of many songs and store them
+       with `Database.insert_songs`, one transaction per batch.
+
+    Files are decoded as soon as they are scanned, so fingerprinting
+    starts while the rest of a directory is still being hashed.
+
+    Worker processes are started once and reused by every `submit`, so
+    repeated `Dejavu.fingerprint_directory` calls don't pay for a new
+    pool. Writers run in the parent process, which keeps the database
+    connection there and works with in-process databases too.
+
+    `known_hashes` is the set of file SHA1s already in the database. It
+    is updated in place, under `lock`, as songs are written, and files
+    whose SHA1 is already in it are skipped.
+
+    If a worker process dies, `wait` reports the files still outstanding
+    as failed, as it can't tell which one was lost, and the pipeline is
+    `broken`: it takes no more files and has to be replaced by a new one.
+    Files the other workers were still busy with may be stored anyway,
+    and are then skipped as already fingerprinted next time.
+    """
+
+    def __init__(self, db, known_hashes, lock, decoders=1, fingerprinters=1,
+                 writers=1, batch_size=DEFAULT_BATCH_SIZE,
+                 scanners=DEFAULT_SCANNERS, hash_cache=None):
+        super(IngestPipeline, self).__init__()
+        self.db = db
+        self.known_hashes = known_hashes
+        self.lock = lock
+        self.batch_size = batch_size
+        self.hash_cache = hash_cache
+        self.workers = (scanners, decoders, fingerprinters, writers)
+
+        self._scan = Queue.Queue()
+        # bounded so decoded audio can't pile up ahead of fingerprinting
+        self._files = multiprocessing.Queue()
+        self._audio = multiprocessing.Queue(maxsize=2 * fingerprinters)
+        self._hashes = multiprocessing.Queue(maxsize=2 * fingerprinters)
+        self._results = Queue.Queue()
+        self._outstanding = 0
+        # submitted files without a result yet, by name
+        self._submitted = defaultdict(int)
+        # why the pipeline stopped working, if it did
+        self.broken = None
+
+        self._decoders = [
+            multiprocessing.Process(target=_decode_worker,
+                                    args=(self._files, self._audio,
+                                          self._hashes))
+            for _ in xrange(decoders)]
+        self._fingerprinters = [
+            multiprocessing.Process(target=_fingerprint_stage_worker,
+                                    args=(self._audio, self._hashes,
+                                          db.hash_format, db.profile))
+            for _ in xrange(fingerprinters)]
+        self._writers = [threading.Thread(target=self._write)
+                         for _ in xrange(writers)]
+        self._scanners = [threading.Thread(target=self._scan_files)
+                          for _ in xrange(scanners)]
+
+        for worker in (self._decoders + self._fingerprinters + self._writers +
+                       self._scanners):
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, filename, song_name=None):
+        """
+        Queues a file for fingerprinting.
+        """
+        if self.broken:
+            raise IngestError(self.broken)
+        self._outstanding += 1
+        self._submitted[filename] += 1
+        self._scan.put((filename, song_name))
+
+    def wait(self):
+        """
+        Blocks until every submitted file has been written, skipped or
+        has failed, printing progress like `fingerprint_directory` always
+        did. The files outstanding when a worker process dies fail.
+
+        Returns the number of songs that were added.
+        """
+        added = 0
+        while self._outstanding:
+            try:
+                result = self._results.get(timeout=WORKER_CHECK_INTERVAL)
+            except Queue.Empty:
+                dead = [worker for worker in
+                        self._decoders + self._fingerprinters
+                        if not worker.is_alive()]
+                if dead:
+                    self._fail_outstanding(dead)
+                continue
+            self._outstanding -= 1
+
+            status, filename = result[:2]
+            self._submitted[filename] -= 1
+            if not self._submitted[filename]:
+                del self._submitted[filename]
+            if status == RESULT_DONE:
+                added += 1
+            elif status == RESULT_SKIPPED:
+                print "%s already fingerprinted, continuing..." % filename
+            else:
+                print("Failed fingerprinting %s" % filename)
+                # Print traceback because we can't reraise it here
+                sys.stdout.write(result[2])
+        return added
+
+    def _fail_outstanding(self, dead):
+        self.broken = "; ".join(
+            "%s exited with code %s" % (worker.name, worker.exitcode)
+            for worker in dead)
+        for filename, count in sorted(self._submitted.iteritems()):
+            for _ in xrange(count):
+                print("Failed fingerprinting %s: %s" % (filename,
+                                                        self.broken))
+        self._submitted.clear()
+        self._outstanding = 0
+
+    def close(self):
+        """
+        Stops all workers once the queued files are done, or right away
+        if the pipeline is `broken`.
+        """
+        for _ in self._scanners:
+            self._scan.put(None)
+        for worker in self._scanners:
+            worker.join()
+
+        processes = self._decoders + self._fingerprinters
+        if self.broken:
+            # the queues may be full with nobody left to read them
+            for worker in processes:
+                worker.terminate()
+        else:
+            for _ in self._decoders:
+                self._files.put(None)
+            for worker in self._decoders:
+                worker.join()
+
+            for _ in self._fingerprinters:
+                self._audio.put(None)
+        for worker in processes:
+            worker.join()
+
+        for _ in self._writers:
+            self._hashes.put(None)
+        for worker in self._writers:
+            worker.join()
+
+    def _scan_files(self):
+        unique_hash = (self.hash_cache.unique_hash if self.hash_cache
+                       else decoder.unique_hash)
+
+        for filename, song_name in iter(self._scan.get, None):
+            try:
+                file_hash = unique_hash(filename)
+            except Exception:
+                self._results.put((RESULT_FAILED, filename,
+                                   traceback.format_exc()))
+                continue
+
+            # don't refingerprint already fingerprinted files
+            with self.lock:
+                known = file_hash in self.known_hashes
+            if known:
+                self._results.put((RESULT_SKIPPED, filename))
+            else:
+                self._files.put((filename, song_name, file_hash))
+
+    def _write(self):
+        finished = False
+        while not finished:
+            batch, rows = [], 0
+            timeout = None
+            while rows < self.batch_size:
+                try:
+                    item = self._hashes.get(timeout=timeout)
+                except Queue.Empty:
+                    break
+                if item is None:
+                    finished = True
+                    break
+                if item[0] == RESULT_FAILED:
+                    self._results.put(item)
+                    continue
+
+                batch.append(item)
+                rows += len(item[3])
+                # once a batch is started, only wait a little for more
+                timeout = DEFAULT_BATCH_TIMEOUT
+
+            if batch:
+                self._store(batch)
+
+    def _store(self, batch):
+        songs, stored = [], []
+        with self.lock:
+            for _, filename, song_name, file_hash, hashes in batch:
+                if file_hash in self.known_hashes:
+                    self._results.put((RESULT_SKIPPED, filename))
+                    continue
+                # claim the hash so other writers skip duplicates
+                self.known_hashes.add(file_hash)
+                songs.append((song_name, file_hash, hashes))
+                stored.append((filename, file_hash))
+
+        try:
+            sids = self.db.insert_songs(songs)
+        except Exception:
+            with self.lock:
+                for _, file_hash in stored:
+                    self.known_hashes.discard(file_hash)
+            error = traceback.format_exc()
+            for filename, _ in stored:
+                self._results.put((RESULT_FAILED, filename, error))
+        else:
+            for (filename, _), sid in zip(stored, sids):
+                self._results.put((RESULT_DONE, filename, sid))
+
+
+def decode_file(filename, file_hash=None):
+    """
+    Reads an audio file, `file_hash` being its SHA1 if already known.
+
+    returns: (channels, sample rate, file hash)
+    """
+    channels, Fs = decoder.read_file(filename)
+    return channels, Fs, file_hash or decoder.unique_hash(filename)
+
+
+def fingerprint_channels(channels, Fs, hash_format, filename=None,
+                         profile=None):
+    """
+    Fingerprints the channels `profile` selects, analysed as it says, and
+    returns the union of their hashes.
+    """
+    result = set()
+    channels = fingerprint.select_channels(channels, profile)
+    channel_amount = len(channels)
+
+    for channeln, channel in enumerate(channels):
+        # TODO: Remove prints or change them into optional logging.
+        print("Fingerprinting channel %d/%d for %s" % (channeln + 1,
+                                                       channel_amount,
+                                                       filename))
+        hashes = fingerprint.fingerprint_stream(channel, Fs=Fs,
+                                                hash_format=hash_format,
+                                                profile=profile)
+        print("Finished channel %d/%d for %s" % (channeln + 1, channel_amount,
+                                                 filename))
+        result.update(hashes)
+
+    return result
+
+
+def _decode_worker(files, audio, results):
+    for filename, song_name, file_hash in iter(files.get, None):
+        song_name = song_name or decoder.path_to_songname(filename)
+        try:
+            if decoder.wav_info(filename) is not None:
+                # PCM WAV files are memory-mapped by the fingerprinter
+                # itself rather than copied through the queue
+                audio.put((filename, song_name, None, None, file_hash))
+                continue
+            channels, Fs, file_hash = decode_file(filename, file_hash)
+        except Exception:
+            # failures skip the remaining stages
+            results.put((RESULT_FAILED, filename, traceback.format_exc()))
+        else:
+            audio.put((filename, song_name, channels, Fs, file_hash))
+
+
+def _fingerprint_stage_worker(audio, results, hash_format, profile):
+    for filename, song_name, channels, Fs, file_hash in iter(audio.get, None):
+        try:
+            if channels is None:
+                channels, Fs = decoder.read_file(filename)
+            hashes = fingerprint_channels(channels, Fs, hash_format,
+                                          filename, profile)
+        except Exception:
+            results.put((RESULT_FAILED, filename, traceback.format_exc()))
+        else:
+            results.put((RESULT_DONE, filename, song_name, file_hash,
+                         hashes))
+
+
+class IngestError(Exception):
+    pass
@@ -1,10 +1,32 @@
+import collections
+import multiprocessing
 import time
 
 import numpy as np
-from pydub import AudioSegment
 
 import dejavu.decoder as decoder
 import dejavu.fingerprint as fingerprint
+from dejavu import _align_candidates
+
+######################################################################
+# Number of aligned hashes (the "confidence" of a match) at which
+# `StreamRecognizer` reports a match without waiting for more audio.
+DEFAULT_STREAM_THRESHOLD = 50
+
+######################################################################
+# Seconds of most recent audio whose matches `StreamRecognizer` keeps
+# while waiting for a match to reach the threshold.
+DEFAULT_STREAM_WINDOW = 10
+
+######################################################################
+# Number of frames `StreamRecognizer.listen` reads from a stream at once.
+DEFAULT_STREAM_CHUNK = 4096
+
+######################################################################
+# Spectrogram columns the offset of a reported match may move by while
+# the same song plays on, without `StreamRecognizer` reporting it again.
+# The best offset of a match often moves by a column as audio arrives.
+STREAM_OFFSET_TOLERANCE = 2
 
 
 class FileRecognizer:
@@ -12,33 +34,168 @@ class FileRecognizer:
     def __init__(self, dejavu):
         self.dejavu = dejavu
         self.Fs = fingerprint.DEFAULT_FS
+        self.wsize = fingerprint.DEFAULT_WINDOW_SIZE
 
-    def _recognize(self, *data):
-        matches = []
-        for d in data:
-            matches.extend(self.dejavu.find_matches(d, Fs=self.Fs))
-        return self.dejavu.align_matches(matches)
+    def _recognize(self, *data, **kwargs):
+        data = fingerprint.select_channels(data, self.dejavu.db.profile)
+        hashes = [self.dejavu.generate_fingerprints(d, Fs=self.Fs)
+                  for d in data]
+        return self._match(hashes, topn=kwargs.get('topn'))
 
-    def recognize(self, filename, split_milliseconds, start_milliseconds, limit_milliseconds):
+    def _match(self, channel_hashes, topn=None):
+        """
+        Aligns the matches of the hashes of every channel together.
+        """
+        channel_matches = [self.dejavu.db.return_match_arrays(hashes)
+                           for hashes in channel_hashes]
+        return self._align(channel_matches,
+                           sum(len(hashes) for hashes in channel_hashes),
+                           topn=topn)
 
-        matches = []
-        audio_file = AudioSegment.from_file(filename)
-        max_milliseconds = audio_file.duration_seconds * 1000 - start_milliseconds
+    def _align(self, channel_matches, input_hashes, topn=None):
+        if not channel_matches:
+            return [] if topn is not None else None
+        sids, diffs = zip(*channel_matches)
+        return self.dejavu.align_matches(
+            (np.concatenate(sids), np.concatenate(diffs)), topn=topn,
+            input_hashes=input_hashes)
+
+    def _columns(self, start_milliseconds, end_milliseconds):
+        """
+        Returns the first and last spectrogram columns lying completely
+        within [start_milliseconds, end_milliseconds).
+        """
+        wsize = self.wsize
+        step = wsize - int(wsize * fingerprint.DEFAULT_OVERLAP_RATIO)
+        first = int(start_milliseconds * self.Fs / 1000.0)
+        last = int(end_milliseconds * self.Fs / 1000.0)
+        return -(-first // step), (last - wsize) // step
+
+    def _segment_hashes(self, peaks, start_milliseconds, end_milliseconds):
+        """
+        Hashes the peaks of the spectrogram columns lying completely within
+        [start_milliseconds, end_milliseconds), with offsets relative to the
+        first of those columns, like fingerprinting the segment alone would.
+        """
+        begin, end = self._columns(start_milliseconds, end_milliseconds)
+
+        times = peaks[:, fingerprint.IDX_TIME_J]
+        peaks = peaks[(times >= begin) & (times <= end)]
+        peaks[:, fingerprint.IDX_TIME_J] -= begin
+        fan_value = fingerprint.get_fan_value(self.dejavu.db.profile)
+        return fingerprint.generate_hashes(
+            peaks, fan_value=fan_value,
+            hash_format=self.dejavu.db.hash_format)
+
+    def recognize(self, filename, split_milliseconds, start_milliseconds, limit_milliseconds,
+                  topn=None, nprocesses=None):
+        """
+        Recognizes `filename` in segments of `split_milliseconds`.
+
+        The file is decoded once and the peaks of every channel are found
+        in one pass over all segments; each segment then only hashes the
+        peaks within its time range. The hashes of all segments are looked
+        up together with `Database.return_segment_match_arrays`.
+
+        With `nprocesses` > 1 the segments are split into runs of
+        consecutive segments, recognized concurrently by a pool of that
+        many processes.
+
+        Returns one match per segment, or with `topn` a list of up to
+        `topn` candidate matches per segment (see `Dejavu.align_matches`).
+        """
+
+        # PCM WAV files are memory-mapped, anything else goes through pydub
+        channels, self.Fs = decoder.read_file(filename)
+        nsamples = len(channels[0]) if channels else 0
+        max_milliseconds = nsamples * 1000.0 / self.Fs - start_milliseconds
 
         if limit_milliseconds is not None and max_milliseconds > limit_milliseconds:
             max_milliseconds = limit_milliseconds
 
-        segments = np.math.ceil(max_milliseconds / split_milliseconds)
-        for seg in range(0, int(segments)):
-            start = start_milliseconds + seg * split_milliseconds
-            temp_audio_file = audio_file[start:start + split_milliseconds]
-            frames, self.Fs, file_hash = decoder.read(filename, temp_audio_file)
+        segments = int(np.math.ceil(max_milliseconds / split_milliseconds))
+        if segments <= 0:
+            return []
 
+        first = int(start_milliseconds * self.Fs / 1000.0)
+        last = int((start_milliseconds + segments * split_milliseconds) *
+                   self.Fs / 1000.0)
+        channels = [channel[first:last] for channel in channels]
+        channels = fingerprint.select_channels(channels,
+                                               self.dejavu.db.profile)
+
+        # resample once for all segments, to the database's analysis rate
+        rate, self.wsize, _ = fingerprint.analysis(self.dejavu.db.profile,
+                                                   self.Fs)
+        channels = [fingerprint.resample(channel, self.Fs, rate)
+                    for channel in channels]
+        self.Fs = rate
+
+        if not nprocesses or nprocesses <= 1 or segments == 1:
+            return self._recognize_segments(channels, split_milliseconds, 0,
+                                            segments, topn)
+
+        # a few runs per process so that uneven runs even out
+        run = int(np.math.ceil(segments / (nprocesses * 4.0)))
+        tasks = [(split_milliseconds, seg, min(seg + run, segments), topn)
+                 for seg in range(0, segments, run)]
+
+        # workers inherit this recognizer and the decoded channels
+        self.dejavu.db.before_fork()
+        pool = multiprocessing.Pool(nprocesses, initializer=_init_worker,
+                                    initargs=(self, channels))
+        try:
+            results = pool.map(_recognize_worker, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [match for matches in results for match in matches]
+
+    def _recognize_segments(self, channels, split_milliseconds,
+                            first_segment, last_segment, topn=None):
+        """
+        Recognizes segments [first_segment, last_segment) of the channels.
+
+        Only the peaks of those segments are computed, but on the
+        spectrogram of the whole channels, so results don't depend on how
+        segments are distributed between processes.
+        """
+        matches = []
+        starts = [seg * split_milliseconds
+                  for seg in range(first_segment, last_segment)]
+        begin, _ = self._columns(starts[0], starts[0] + split_milliseconds)
+        _, end = self._columns(starts[-1], starts[-1] + split_milliseconds)
+        peaks = [fingerprint.get_peaks(channel, Fs=self.Fs, wsize=self.wsize,
+                                       start=begin, end=end + 1,
+                                       profile=self.dejavu.db.profile)
+                 for channel in channels]
+
+        # hash every segment, then look them all up in a single batch
+        t = time.time()
+        hashes = [[self._segment_hashes(channel_peaks, start,
+                                        start + split_milliseconds)
+                   for channel_peaks in peaks]
+                  for start in starts]
+        lookups = self.dejavu.db.return_segment_match_arrays(
+            [channel_hashes for segment in hashes
+             for channel_hashes in segment])
+        # the shared part of the work is split evenly between segments
+        shared_time = (time.time() - t) / len(starts)
+
+        nchannels = len(channels)
+        for seg, segment in enumerate(hashes):
             t = time.time()
-            match = self._recognize(*frames)
-            t = time.time() - t
+            match = self._align(
+                lookups[seg * nchannels:(seg + 1) * nchannels],
+                sum(len(channel_hashes) for channel_hashes in segment),
+                topn=topn)
+            t = time.time() - t + shared_time
 
-            if match:
+            if topn is not None:
+                for candidate in match:
+                    candidate['match_time'] = t
+            elif match:
                 match['match_time'] = t
 
             matches.append(match)
@@ -46,5 +203,165 @@ class FileRecognizer:
         return matches
 
 
+# (FileRecognizer, channels) of the file recognized by a worker process
+_worker_state = None
+
+
+def _init_worker(recognizer, channels):
+    global _worker_state
+    recognizer.dejavu.db.after_fork()
+    _worker_state = (recognizer, channels)
+
+
+def _recognize_worker(task):
+    recognizer, channels = _worker_state
+    return recognizer._recognize_segments(channels, *task)
+
+
+class StreamRecognizer(object):
+    """
+    Recognizes audio while it is being received, from any source of
+    16 bit PCM: a pipe, a socket, a file still being written, ...
+
+    Each channel is fingerprinted incrementally by a
+    `fingerprint.StreamFingerprinter`, so a chunk only costs the
+    spectrogram columns it completes, and the new hashes are looked up
+    right away. The matches of the last `window_seconds` are aligned
+    after every chunk, and a match is reported as soon as its confidence
+    reaches `threshold`; songs are only read from the database then. It
+    isn't reported again while the same song keeps playing at the same
+    alignment, give or take STREAM_OFFSET_TOLERANCE columns.
+
+    Offsets of the matches are relative to the start of the stream.
+
+    Channels are mixed as the database's analysis profile says, except
+    that "loudest" can't be known before the stream ends, so every
+    channel is fingerprinted then.
+    """
+
+    def __init__(self, dejavu, Fs=fingerprint.DEFAULT_FS, channels=1,
+                 threshold=DEFAULT_STREAM_THRESHOLD,
+                 window_seconds=DEFAULT_STREAM_WINDOW):
+        super(StreamRecognizer, self).__init__()
+        self.dejavu = dejavu
+        self.Fs = Fs
+        self.channels = channels
+        self.threshold = threshold
+
+        rate, wsize, _ = fingerprint.analysis(dejavu.db.profile, Fs)
+        step = wsize - int(wsize * fingerprint.DEFAULT_OVERLAP_RATIO)
+        self.window_columns = int(window_seconds * rate / step)
+
+        profile = dejavu.db.profile
+        self._downmix = (
+            profile is not None and channels > 1 and
+            fingerprint.get_profile(profile)["channels"] ==
+            fingerprint.CHANNELS_MONO)
+        self._fingerprinters = [
+            fingerprint.StreamFingerprinter(
+                Fs=Fs, hash_format=dejavu.db.hash_format, profile=profile)
+            for _ in xrange(1 if self._downmix else channels)]
+        # bytes of an incomplete frame left over from the last chunk
+        self._remainder = ""
+        # (last column, sids, offset differences, number of hashes)
+        self._window = collections.deque()
+        # (song id, offset) of the last reported match, or of its repeats
+        self._reported = None
+
+    def feed(self, data):
+        """
+        Adds audio to the stream, either raw little-endian 16 bit PCM
+        with interleaved channels or an array of samples, shaped
+        (frames, channels) for more than one channel.
+
+        Returns the match found, or None.
+        """
+        if isinstance(data, basestring):
+            data = self._remainder + data
+            frame = 2 * self.channels
+            usable = len(data) - len(data) % frame
+            self._remainder = data[usable:]
+            data = np.fromstring(data[:usable], dtype='<i2')
+
+        samples = np.asarray(data).reshape(-1, self.channels)
+        if self._downmix:
+            samples = fingerprint.downmix(samples.T)[:, np.newaxis]
+        for chn, fingerprinter in enumerate(self._fingerprinters):
+            self._lookup(fingerprinter.feed(samples[:, chn]))
+        return self._match()
+
+    def flush(self):
+        """
+        Ends the stream, matching the audio that is still buffered.
+
+        Returns the match found, or None.
+        """
+        for fingerprinter in self._fingerprinters:
+            self._lookup(fingerprinter.flush())
+        return self._match()
+
+    def listen(self, stream, chunk_size=DEFAULT_STREAM_CHUNK):
+        """
+        Reads raw PCM from the file-like `stream` until it ends, yielding
+        every match as soon as it is found.
+        """
+        while True:
+            data = stream.read(chunk_size * 2 * self.channels)
+            if not data:
+                break
+            match = self.feed(data)
+            if match:
+                yield match
+
+        match = self.flush()
+        if match:
+            yield match
+
+    def recognize(self, stream, chunk_size=DEFAULT_STREAM_CHUNK):
+        """
+        Returns the first match found in `stream`, or None.
+        """
+        for match in self.listen(stream, chunk_size):
+            return match
+        return None
+
+    def _lookup(self, hashes):
+        if not hashes:
+            return
+        sids, diffs = self.dejavu.db.return_match_arrays(hashes)
+        last = max(offset for _, offset in hashes)
+        self._window.append((last, sids, diffs, len(hashes)))
+
+        # forget matches that slid out of the window
+        while self._window[0][0] < last - self.window_columns:
+            self._window.popleft()
+
+    def _match(self):
+        if not self._window:
+            return None
+
+        t = time.time()
+        _, sids, diffs, counts = zip(*self._window)
+        sids, diffs = np.concatenate(sids), np.concatenate(diffs)
+        # the best alignment is cheap, the song lookup isn't
+        candidates = _align_candidates(sids, diffs, 1)
+        if not candidates or candidates[0][2] < self.threshold:
+            return None
+
+        song_id, offset, _ = candidates[0]
+        reported, self._reported = self._reported, (song_id, offset)
+        if reported is not None and reported[0] == song_id and (
+                abs(offset - reported[1]) <= STREAM_OFFSET_TOLERANCE):
+            return None
+
+        match = self.dejavu.align_matches((sids, diffs),
+                                          input_hashes=sum(counts))
+        if not match:
+            self._reported = reported
+            return None
+        match['match_time'] = time.time() - t
+        return match
+
+
 class NoRecordingError(Exception):
     pass
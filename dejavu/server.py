@@ -0,0 +1,281 @@
+import BaseHTTPServer
+import json
+import multiprocessing
+import os
+import Queue
+import SocketServer
+import tempfile
+import threading
+import time
+import traceback
+import urlparse
+
+import numpy as np
+
+import dejavu.decoder as decoder
+import dejavu.fingerprint as fingerprint
+
+######################################################################
+# Seconds the lookup batcher waits for more requests to join a batch
+# once the first one arrived. Longer windows share more queries under
+# load at the cost of latency for lone requests.
+DEFAULT_BATCH_WINDOW = 0.01
+
+######################################################################
+# Maximum number of requests whose hashes are looked up together.
+DEFAULT_MAX_BATCH = 64
+
+######################################################################
+# Port the recognition server listens on by default.
+DEFAULT_PORT = 8000
+
+######################################################################
+# Largest clip, in bytes, the recognition server accepts; larger
+# requests are refused before their body is read.
+DEFAULT_MAX_CLIP_SIZE = 32 * 1024 * 1024
+
+
+class RecognitionServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP recognition service.
+
+    POST an audio clip (any format the decoder reads) to /recognize,
+    optionally with ?topn=N, and the match is returned as JSON. Clips
+    over `max_clip_size` bytes are refused with 413 and clips that can't
+    be decoded with 400. Other failures are logged and answered with a
+    generic 500.
+
+    Every request is handled by its own thread, but the expensive parts
+    are shared: clips are decoded and fingerprinted by a pool of
+    `nprocesses` processes, and the hash lookups of concurrent requests
+    are coalesced by a `LookupBatcher` into one
+    `Database.return_segment_match_arrays` call, so a burst of requests
+    costs one set of queries on one connection instead of one per
+    request.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, dejavu, address=("", DEFAULT_PORT), nprocesses=None,
+                 batch_window=DEFAULT_BATCH_WINDOW,
+                 max_batch=DEFAULT_MAX_BATCH,
+                 max_clip_size=DEFAULT_MAX_CLIP_SIZE):
+        self.dejavu = dejavu
+        self.max_clip_size = max_clip_size
+
+        try:
+            nprocesses = nprocesses or multiprocessing.cpu_count()
+        except NotImplementedError:
+            nprocesses = 1
+        else:
+            nprocesses = 1 if nprocesses <= 0 else nprocesses
+
+        # fork before any thread exists
+        dejavu.db.before_fork()
+        self.pool = multiprocessing.Pool(nprocesses)
+        self.batcher = LookupBatcher(dejavu.db, batch_window, max_batch)
+
+        BaseHTTPServer.HTTPServer.__init__(self, address, _RecognitionHandler)
+
+    def recognize(self, data, topn=None):
+        """
+        Recognizes the audio clip in the string `data`.
+
+        Returns a match, or with `topn` a list of up to `topn` matches
+        (see `Dejavu.align_matches`).
+        """
+        t = time.time()
+        channel_hashes = self.pool.apply(
+            _fingerprint_clip, (data, self.dejavu.db.hash_format,
+                                self.dejavu.db.profile))
+        channel_matches = self.batcher.lookup(channel_hashes)
+
+        if not channel_matches:
+            return [] if topn is not None else None
+        sids, diffs = zip(*channel_matches)
+        match = self.dejavu.align_matches(
+            (np.concatenate(sids), np.concatenate(diffs)), topn=topn,
+            input_hashes=sum(len(hashes) for hashes in channel_hashes))
+
+        t = time.time() - t
+        if topn is not None:
+            for candidate in match:
+                candidate['match_time'] = t
+        elif match:
+            match['match_time'] = t
+        return match
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        self.batcher.close()
+        self.pool.terminate()
+        self.pool.join()
+
+
+class LookupBatcher(object):
+    """
+    Coalesces hash lookups made concurrently by many threads.
+
+    The first lookup to arrive opens a batch, which collects every other
+    lookup made within `window` seconds, up to `max_size` of them. The
+    whole batch is then answered by one
+    `Database.return_segment_match_arrays` call, which also looks up
+    hashes shared between requests only once.
+    """
+
+    def __init__(self, db, window=DEFAULT_BATCH_WINDOW,
+                 max_size=DEFAULT_MAX_BATCH):
+        super(LookupBatcher, self).__init__()
+        self.db = db
+        self.window = window
+        self.max_size = max_size
+
+        self._queue = Queue.Queue()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def lookup(self, channel_hashes):
+        """
+        Looks up lists of (hash, offset) pairs as part of the next batch.
+
+        returns: a (sids, offset_differences) pair of arrays per list
+        """
+        request = _Lookup(channel_hashes)
+        self._queue.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.result
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self):
+        for first in iter(self._queue.get, None):
+            batch = [first]
+            deadline = time.time() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=remaining)
+                except Queue.Empty:
+                    break
+                if request is None:
+                    # answer this batch, then stop
+                    self._queue.put(None)
+                    break
+                batch.append(request)
+
+            self._answer(batch)
+
+    def _answer(self, batch):
+        lists = [hashes for request in batch for hashes in request.hashes]
+        try:
+            results = self.db.return_segment_match_arrays(lists)
+        except Exception as e:
+            for request in batch:
+                request.error = e
+        else:
+            position = 0
+            for request in batch:
+                request.result = results[position:
+                                         position + len(request.hashes)]
+                position += len(request.hashes)
+
+        for request in batch:
+            request.done.set()
+
+
+class _Lookup(object):
+
+    def __init__(self, hashes):
+        self.hashes = hashes
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class _RecognitionHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != "/recognize":
+            self._respond(404, {"error": "Not found."})
+            return
+
+        try:
+            query = urlparse.parse_qs(url.query)
+            topn = int(query["topn"][0]) if "topn" in query else None
+            length = int(self.headers.getheader("Content-Length", 0))
+            if length < 0:
+                raise ValueError("Invalid Content-Length: %d" % length)
+        except ValueError as e:
+            self.close_connection = 1
+            self._respond(400, {"error": str(e)})
+            return
+
+        if length > self.server.max_clip_size:
+            # the body is left unread
+            self.close_connection = 1
+            self._respond(413, {"error": "Clips are limited to %d bytes." %
+                                         self.server.max_clip_size})
+            return
+
+        try:
+            match = self.server.recognize(self.rfile.read(length), topn=topn)
+        except ClipDecodeError as e:
+            self._respond(400, {"error": "Could not decode the clip: %s" % e})
+        except Exception:
+            self.log_error("Recognition failed:\n%s", traceback.format_exc())
+            self._respond(500, {"error": "Internal error"})
+        else:
+            self._respond(200, match)
+
+    def _respond(self, status, body):
+        body = json.dumps(body, default=_json_default)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def _json_default(value):
+    # NumPy scalars that made it into a match
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError("%r is not JSON serializable" % (value,))
+
+
+class ClipDecodeError(Exception):
+    pass
+
+
+def _fingerprint_clip(data, hash_format, profile):
+    """
+    Decodes an audio clip and fingerprints the channels `profile`
+    selects, analysed as it says.
+
+    returns: a list of (hash, offset) pairs per channel
+    """
+    fd, path = tempfile.mkstemp(prefix="dejavu-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        try:
+            channels, Fs = decoder.read_file(path)
+        except Exception as e:
+            # pydub and the WAV reader fail in many ways on bad input
+            raise ClipDecodeError(str(e) or e.__class__.__name__)
+        channels = fingerprint.select_channels(channels, profile)
+        return [fingerprint.fingerprint(np.asarray(channel), Fs=Fs,
+                                        hash_format=hash_format,
+                                        profile=profile)
+                for channel in channels]
+    finally:
+        os.remove(path)
@@ -0,0 +1,120 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+from scipy import fftpack
+
+######################################################################
+# Floor of the spectrogram power before the log transform. Silence comes
+# out as LOG_FLOOR = 10 * log10(LOG_EPSILON) dB instead of -inf, far below
+# any amplitude a peak needs; the peak detectors treat cells at LOG_FLOOR
+# as background, like the zeros `mlab.specgram` left.
+LOG_EPSILON = 1e-10
+
+# Hanning windows by size, see `hanning`
+_windows = {}
+
+
+class Spectrogram(object):
+    """
+    Log-power spectrogram on the scale `mlab.specgram` had: 10 * log10 of
+    the one-sided power spectral density of Hanning windowed frames,
+    frequencies on the first axis and time on the second.
+
+    It is computed in float32. Frames are strided views of the samples,
+    multiplied by a cached window into a single buffer that a real FFT
+    transforms in place, and the log is taken in place on the output.
+
+    With `reuse` the frame and output buffers are kept for the next call,
+    which saves allocating them for every block of a long recording but
+    overwrites the array the previous call returned.
+    """
+
+    def __init__(self, Fs, wsize, wratio, reuse=False):
+        super(Spectrogram, self).__init__()
+        self.Fs = Fs
+        self.wsize = wsize
+        self.noverlap = int(wsize * wratio)
+        self.reuse = reuse
+        self.nfreqs = wsize // 2 + 1
+        self.window = hanning(wsize)
+
+        # a one-sided density counts every bin but DC (and Nyquist) twice
+        scale = np.empty(self.nfreqs, dtype=np.float64)
+        scale.fill(2.0)
+        scale[0] = 1.0
+        if not wsize % 2:
+            scale[-1] = 1.0
+        scale /= Fs * np.square(self.window.astype(np.float64)).sum()
+        self._scale = scale.astype(np.float32)
+
+        self._frames = self._power = None
+
+    def __call__(self, samples):
+        """
+        returns: float32 array of shape (wsize // 2 + 1, frames)
+        """
+        samples = np.asarray(samples)
+        if len(samples) < self.wsize:
+            # like mlab, a short signal is a single zero padded frame
+            padded = np.zeros(self.wsize, dtype=samples.dtype)
+            padded[:len(samples)] = samples
+            samples = padded
+
+        step = self.wsize - self.noverlap
+        nframes = (len(samples) - self.noverlap) // step
+        stride = samples.strides[0]
+        frames = as_strided(samples, shape=(nframes, self.wsize),
+                            strides=(step * stride, stride))
+
+        buf, power = self._buffers(nframes)
+        np.multiply(frames, self.window, out=buf)
+        # rows become [DC, re 1, im 1, re 2, im 2, ...]
+        packed = fftpack.rfft(buf, axis=1, overwrite_x=True)
+        np.square(packed, out=packed)
+
+        power[:, 0] = packed[:, 0]
+        if self.wsize % 2:
+            np.add(packed[:, 1::2], packed[:, 2::2], out=power[:, 1:])
+        else:
+            np.add(packed[:, 1:-1:2], packed[:, 2:-1:2], out=power[:, 1:-1])
+            power[:, -1] = packed[:, -1]
+
+        power *= self._scale
+        return _to_decibels(power).T
+
+    def _buffers(self, nframes):
+        if self.reuse and self._frames is not None:
+            if len(self._frames) >= nframes:
+                return self._frames[:nframes], self._power[:nframes]
+
+        frames = np.empty((nframes, self.wsize), dtype=np.float32)
+        power = np.empty((nframes, self.nfreqs), dtype=np.float32)
+        if self.reuse:
+            self._frames, self._power = frames, power
+        return frames, power
+
+
+def _to_decibels(power):
+    """
+    Floors the float32 power at LOG_EPSILON and converts it to dB in place.
+    """
+    np.maximum(power, LOG_EPSILON, out=power)
+    np.log10(power, out=power)
+    power *= 10
+    return power
+
+
+# computed like the spectrogram, so silent cells compare equal to it
+LOG_FLOOR = _to_decibels(np.zeros(1, dtype=np.float32))[0]
+
+
+def hanning(wsize):
+    """
+    Returns the read-only float32 Hanning window of `wsize` samples,
+    computed once per size.
+    """
+    window = _windows.get(wsize)
+    if window is None:
+        window = np.hanning(wsize).astype(np.float32)
+        window.flags.writeable = False
+        _windows[wsize] = window
+    return window